@@ -1,24 +1,49 @@
 from sumtool.storage import get_summaries, store_summary_metrics
 import argparse
 from src.data_utils import load_xsum_dict
-from src.detect_entities import detect_entities
-from tqdm import tqdm
+from src.detect_entities import (
+    configure_ner_cache,
+    configure_nlp,
+    detect_entities_batch,
+)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("model", type=str)
+    parser.add_argument("--spacy_tier", type=str, default="lg", help="sm|md|lg")
+    parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument(
+        "--n_process",
+        type=int,
+        default=1,
+        help="spaCy worker processes, each loads its own copy of the model",
+    )
+    parser.add_argument(
+        "--ner_cache_path",
+        type=str,
+        default="",
+        help="SQLite file caching detected entities by summary text",
+    )
     args = parser.parse_args()
+    configure_nlp(args.spacy_tier)
+    configure_ner_cache(args.ner_cache_path)
 
     summaries = get_summaries("xsum", args.model)
     xsum_test = load_xsum_dict("test")
 
-    summary_metadata = {}
-
-    for sum_id, sum_data in tqdm(list(summaries.items())):
-        summary_metadata[sum_id] = {"entities": detect_entities(
-            sum_data["summary"], 
-            xsum_test[sum_id]["document"]
-        )}
+    sum_ids = list(summaries.keys())
+    detected_entities = detect_entities_batch(
+        [
+            (summaries[sum_id]["summary"], xsum_test[sum_id]["document"])
+            for sum_id in sum_ids
+        ],
+        batch_size=args.batch_size,
+        n_process=args.n_process,
+    )
+    summary_metadata = {
+        sum_id: {"entities": entities}
+        for sum_id, entities in zip(sum_ids, detected_entities)
+    }
 
     store_summary_metrics("xsum", args.model, summary_metadata)
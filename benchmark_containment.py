@@ -0,0 +1,55 @@
+import argparse
+import json
+import re
+import time
+
+from src.entity_utils import entities_contained_in
+
+
+def regex_contained_in(entities, text):
+    """
+    Per-entity case-insensitive regex search, as `in_source` used to be
+    computed.
+    """
+    contained = set()
+    for entity in entities:
+        pattern = entity.replace("'s", "") if entity.endswith("'s") else entity
+        if re.search(re.escape(pattern), text, re.IGNORECASE) is not None:
+            contained.add(entity)
+    return contained
+
+
+def run(contained_fn, examples):
+    start_time = time.time()
+    results = [contained_fn(entities, source) for entities, source in examples]
+    return time.time() - start_time, results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="benchmarks in_source containment checks of entities"
+    )
+    parser.add_argument(
+        "--entity_input_filepath", type=str, default="data/xent-probs/test.json"
+    )
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    with open(args.entity_input_filepath, "r") as f:
+        dataset = json.load(f)
+    examples = [
+        ([x["ent"] for x in example["entities"]], example["source"])
+        for example in dataset
+    ] * args.repeats
+    n_entities = sum(len(entities) for entities, _ in examples)
+
+    regex_time, regex_results = run(regex_contained_in, examples)
+    casefold_time, casefold_results = run(entities_contained_in, examples)
+
+    print(f"{len(examples)} sources, {n_entities} entities")
+    print(f"Per-entity regex: {regex_time:.3f}s")
+    print(
+        f"Casefolded source: {casefold_time:.3f}s "
+        + f"({regex_time / casefold_time:.1f}x speedup)"
+    )
+    print(f"Identical results: {regex_results == casefold_results}")
@@ -0,0 +1,88 @@
+import argparse
+import subprocess
+import sys
+from typing import Dict, List, Set, Tuple
+
+# (entry point, budget in seconds): python arguments that are run with
+# `-X importtime`, the budget is for the total import time
+IMPORT_TIME_BUDGETS: List[Tuple[List[str], float]] = [
+    (["-c", "import src.entity_utils"], 0.2),
+    (["-c", "import src.oracle"], 0.5),
+    (["-c", "import src.detect_entities"], 0.5),
+    (["-c", "import src.data_utils"], 0.2),
+    (["-c", "import src.metrics"], 0.2),
+    (["-c", "import src.evaluation.factuality"], 1.0),
+    (["iterative_constraints.py", "--help"], 1.0),
+]
+
+# Modules that none of the entry points above should import
+HEAVY_MODULES = ["torch", "transformers", "spacy", "datasets", "sumtool", "sklearn"]
+
+
+def parse_importtime(stderr: str) -> Tuple[float, Dict[str, float], Set[str]]:
+    """
+    Returns the total import time, the cumulative import time of every
+    top-level import (in seconds) & the names of all imported modules
+    from `-X importtime` output.
+    """
+    cumulative_by_module = {}
+    imported_modules = set()
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        imported_modules.add(name.strip().split(".")[0])
+        # nested imports are indented below the module importing them
+        if not name[1:].startswith(" "):
+            cumulative_by_module[name.strip()] = int(cumulative) / 1e6
+    return sum(cumulative_by_module.values()), cumulative_by_module, imported_modules
+
+
+def measure(python_args: List[str]) -> Tuple[float, Dict[str, float], Set[str]]:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", *python_args],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr)
+    return parse_importtime(result.stderr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="checks the import time of the key entry points against "
+        + "their budgets (exits with status 1 if any is over budget)"
+    )
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--show_top_n", type=int, default=5)
+    args = parser.parse_args()
+
+    over_budget = []
+    for python_args, budget in IMPORT_TIME_BUDGETS:
+        # best of n, the first run also warms the bytecode cache
+        try:
+            measurements = [measure(python_args) for _ in range(args.repeats)]
+        except RuntimeError as e:
+            print(f"{' '.join(python_args)}: FAILED ({str(e).splitlines()[-1]})")
+            over_budget.append(" ".join(python_args))
+            continue
+        total, cumulative_by_module, imported_modules = min(
+            measurements, key=lambda x: x[0]
+        )
+        heavy = [module for module in HEAVY_MODULES if module in imported_modules]
+        status = "ok" if total <= budget and len(heavy) == 0 else "OVER BUDGET"
+        print(f"{' '.join(python_args)}: {total:.3f}s (budget {budget:.1f}s) {status}")
+        for module, seconds in sorted(
+            cumulative_by_module.items(), key=lambda x: -x[1]
+        )[: args.show_top_n]:
+            print(f"    {module}: {seconds:.3f}s")
+        if len(heavy) > 0:
+            print(f"    imports heavy modules: {', '.join(heavy)}")
+        if status != "ok":
+            over_budget.append(" ".join(python_args))
+
+    if len(over_budget) > 0:
+        print(f"Over budget or failed: {', '.join(over_budget)}")
+        sys.exit(1)
@@ -0,0 +1,53 @@
+import argparse
+import time
+
+from sumtool.storage import get_summaries
+
+from src.detect_entities import SPACY_MODELS, load_nlp
+
+
+def entity_sets(nlp, summaries, batch_size):
+    return [
+        {(ent.text, ent.label_, ent.start_char, ent.end_char) for ent in doc.ents}
+        for doc in nlp.pipe(summaries, batch_size=batch_size)
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="benchmarks lean spaCy NER pipelines against the full lg pipeline"
+    )
+    parser.add_argument("--model", type=str, default="facebook-bart-large-xsum")
+    parser.add_argument("--num_summaries", type=int, default=2000)
+    parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument("--tiers", type=str, default="sm,md,lg")
+    args = parser.parse_args()
+
+    summaries = [x["summary"] for x in get_summaries("xsum", args.model).values()][
+        : args.num_summaries
+    ]
+
+    results = []
+    reference = None
+    for tier, lean in [("lg", False)] + [
+        (tier, True) for tier in args.tiers.split(",")
+    ]:
+        nlp = load_nlp(tier, lean)
+        # warm up
+        list(nlp.pipe(summaries[:10]))
+        start_time = time.time()
+        ents = entity_sets(nlp, summaries, args.batch_size)
+        elapsed_time = time.time() - start_time
+        if reference is None:
+            reference = ents
+        agreement = sum(x == y for x, y in zip(ents, reference)) / len(summaries)
+        name = f"{SPACY_MODELS[tier]} ({'lean' if lean else 'full'})"
+        results.append((name, len(summaries) / elapsed_time, agreement, nlp.pipe_names))
+
+    print(f"{len(summaries)} {args.model} summaries")
+    for name, docs_per_sec, agreement, pipe_names in results:
+        print(
+            f"{name}: {docs_per_sec:.0f} docs/sec, "
+            + f"{agreement:.2%} same entities as en_core_web_lg (full), "
+            + f"components: {pipe_names}"
+        )
@@ -0,0 +1,127 @@
+import argparse
+import json
+import time
+
+import numpy as np
+
+from compute_probs import compute_probs_for_summary, posterior_input_lengths
+from src.data_utils import pack_batches_by_length, split_batches
+from src.generation_utils import load_bart_xsum_cmlm, load_prior_model_and_tokenizer
+from src.prob_computation_utils import build_masked_inputs_and_targets
+
+
+def padded_tokens(lengths, batches_of_idxs):
+    return sum(
+        len(batch_idxs) * max(lengths[i] for i in batch_idxs)
+        for batch_idxs in batches_of_idxs
+    )
+
+
+def run_scheme(
+    name, inputs, prior_model_and_tokenizer, posterior_model_and_tokenizer, **kwargs
+):
+    start_time = time.time()
+    entity_probs = compute_probs_for_summary(
+        masked_inputs=inputs[0],
+        targets=inputs[1],
+        entities=inputs[2],
+        sources=inputs[3],
+        prior_model_and_tokenizer=prior_model_and_tokenizer,
+        posterior_model_and_tokenizer=posterior_model_and_tokenizer,
+        **kwargs,
+    )
+    elapsed_time = time.time() - start_time
+    return name, elapsed_time, np.array(entity_probs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="benchmarks batching schemes & concurrent scoring "
+        + "for prior/posterior entity probabilities"
+    )
+    parser.add_argument(
+        "--entity_input_filepath", type=str, default="data/xent-probs/test.json"
+    )
+    parser.add_argument("--num_examples", type=int, default=50)
+    parser.add_argument("--batch_size", type=int, default=3)
+    parser.add_argument("--max_tokens", type=int, default=4096)
+    args = parser.parse_args()
+
+    with open(args.entity_input_filepath, "r") as f:
+        dataset = json.load(f)[: args.num_examples]
+
+    masked_inputs, targets, entities, sources = [], [], [], []
+    for example in dataset:
+        (
+            example_inputs,
+            example_targets,
+            example_entities,
+            example_sources,
+            _,
+        ) = build_masked_inputs_and_targets(example)
+        masked_inputs.extend(example_inputs)
+        targets.extend(example_targets)
+        entities.extend(example_entities)
+        sources.extend(example_sources)
+    inputs = (masked_inputs, targets, entities, sources)
+
+    prior_model_and_tokenizer = load_prior_model_and_tokenizer("facebook/bart-large")
+    posterior_model_and_tokenizer = load_bart_xsum_cmlm()
+
+    lengths = posterior_input_lengths(
+        masked_inputs, sources, None, posterior_model_and_tokenizer[1]
+    )
+    n_tokens = sum(lengths)
+    padded_tokens_by_scheme = {
+        "fixed": padded_tokens(
+            lengths, list(split_batches(list(range(len(lengths))), args.batch_size))
+        ),
+        "max_tokens": padded_tokens(
+            lengths, pack_batches_by_length(lengths, args.max_tokens)
+        ),
+    }
+
+    results = [
+        run_scheme(
+            "fixed",
+            inputs,
+            prior_model_and_tokenizer,
+            posterior_model_and_tokenizer,
+            batch_size=args.batch_size,
+        ),
+        run_scheme(
+            "max_tokens",
+            inputs,
+            prior_model_and_tokenizer,
+            posterior_model_and_tokenizer,
+            max_tokens=args.max_tokens,
+        ),
+        run_scheme(
+            "fixed+concurrent",
+            inputs,
+            prior_model_and_tokenizer,
+            posterior_model_and_tokenizer,
+            batch_size=args.batch_size,
+            concurrent_scoring=True,
+        ),
+        run_scheme(
+            "max_tokens+concurrent",
+            inputs,
+            prior_model_and_tokenizer,
+            posterior_model_and_tokenizer,
+            max_tokens=args.max_tokens,
+            concurrent_scoring=True,
+        ),
+    ]
+
+    print(f"{len(masked_inputs)} entities, {n_tokens} posterior input tokens")
+    sequential_time = results[0][1]
+    for name, elapsed_time, _ in results:
+        padding = 1 - n_tokens / padded_tokens_by_scheme[name.split("+")[0]]
+        print(
+            f"{name}: {elapsed_time:.2f}s, {n_tokens / elapsed_time:.0f} tokens/s, "
+            + f"{padding:.1%} padding, "
+            + f"{sequential_time / elapsed_time:.2f}x speedup"
+        )
+    max_diff = max(np.abs(results[0][2] - x[2]).max() for x in results[1:])
+    print(f"Max abs difference between schemes: {max_diff:.2e}")
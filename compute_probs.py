@@ -1,14 +1,30 @@
 import argparse
 import json
-from typing import List, Tuple
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
 
 import torch
 from tqdm import tqdm
+from transformers.models.bart.modeling_bart import shift_tokens_right
 from transformers.tokenization_utils_base import BatchEncoding
 
-from src.data_utils import persist_example_with_probs, split_batches
-from src.generation_utils import load_bart_xsum_cmlm, load_prior_model_and_tokenizer
-from src.prob_computation_utils import build_masked_inputs_and_targets
+from src.data_utils import (
+    JsonlAppendWriter,
+    add_probs_to_example,
+    compact_jsonl_examples,
+    pack_batches_by_length,
+    split_batches,
+)
+from src.feature_store import ProbFeatureStore, lookup_or_compute
+from src.generation_utils import (
+    load_bart_xsum_cmlm,
+    load_bart_xsum_cmlm_tokenizer,
+    load_prior_model_and_tokenizer,
+)
+from src.misc_utils import model_id
+from src.prob_computation_utils import build_masked_inputs_and_targets, window_sources
+from src.token_cache import TokenizationCache, source_hash
 
 
 def compute_probs_for_summary(
@@ -21,6 +37,14 @@ def compute_probs_for_summary(
     verbose: bool = False,
     device=torch.device("cuda" if torch.cuda.is_available() else "cpu"),
     batch_size: int = 3,
+    source_ids: Optional[List[List[int]]] = None,
+    scoring: str = "teacher_forced",
+    return_log_probs: bool = False,
+    prior_mode: str = "masked",
+    feature_store: Optional[ProbFeatureStore] = None,
+    max_tokens: Optional[int] = None,
+    concurrent_scoring: bool = False,
+    source_window_tokens: Optional[int] = None,
 ) -> List[Tuple[float]]:
     """
     Compute the joint prior and posterior probabilities of an masked entity, given
@@ -31,38 +55,339 @@ def compute_probs_for_summary(
     Returns a list of tuple of 2 items:
     2. The joint prior probability of all tokens in the masked out entity.
     2. The joint posterior probability of all tokens in the masked out entity.
+
+    `source_ids` optionally holds pre-tokenized sources (one per input,
+    without special tokens, see `TokenizationCache`) so that the sources
+    don't have to be re-tokenized for the posterior input.
+
+    `scoring` is either "teacher_forced" (a single forward pass per model)
+    or "generate" (token by token forced generation, kept as reference).
+
+    With `return_log_probs`, the tuples additionally hold the joint prior &
+    posterior log-probabilities.
+
+    `prior_mode` is either "masked" (prior conditioned on the summary
+    with the entity masked out), "causal" (prior conditioned on the
+    summary to the left of the entity, as with
+    `build_causal_masked_inputs_and_targets`, one pass per entity) or
+    "shared_prefix" (one pass per summary with the summary prefix as
+    decoder context only, see `compute_shared_prefix_prior_probs`).
+
+    With a `feature_store`, only the entities that aren't in the store yet
+    are scored, and their probabilities are written back to it.
+
+    With `max_tokens`, inputs are sorted by posterior input length and
+    packed into batches of at most `max_tokens` padded posterior tokens
+    (instead of `batch_size` inputs in arrival order), which cuts padding
+    of the source articles. Outputs are in input order either way.
+
+    With `concurrent_scoring`, the prior model scores all batches in a
+    separate thread while the posterior model scores them in the calling
+    thread (see `run_concurrently`).
+
+    With `source_window_tokens`, the posterior only sees the source sentences
+    that overlap most with the masked summary & entity, up to that many tokens.
     """
 
     if len(masked_inputs) != len(targets):
         raise ValueError("number of inputs is not the same as the number of targets")
 
-    prior_entity_probs: List[float] = []
-    posterior_entity_probs: List[float] = []
+    if source_window_tokens is not None:
+        sources = window_sources(
+            masked_inputs,
+            entities,
+            sources,
+            posterior_model_and_tokenizer[1],
+            source_window_tokens,
+        )
+        # pre-tokenized source ids are of the full sources
+        source_ids = None
+
+    if feature_store is not None:
+        prior_model_id = model_id(prior_model_and_tokenizer[0])
+        posterior_model_id = model_id(posterior_model_and_tokenizer[0])
+        keys = [
+            ProbFeatureStore.key(
+                prior_model_id,
+                posterior_model_id,
+                masked_inputs[i],
+                targets[i],
+                source_hash(sources[i]),
+                scoring,
+                prior_mode,
+            )
+            for i in range(len(masked_inputs))
+        ]
+
+        def compute_missing(idxs: List[int]):
+            return compute_probs_for_summary(
+                masked_inputs=[masked_inputs[i] for i in idxs],
+                targets=[targets[i] for i in idxs],
+                sources=[sources[i] for i in idxs],
+                entities=[entities[i] for i in idxs],
+                prior_model_and_tokenizer=prior_model_and_tokenizer,
+                posterior_model_and_tokenizer=posterior_model_and_tokenizer,
+                verbose=verbose,
+                device=device,
+                batch_size=batch_size,
+                source_ids=(
+                    [source_ids[i] for i in idxs] if source_ids is not None else None
+                ),
+                scoring=scoring,
+                return_log_probs=True,
+                prior_mode=prior_mode,
+                max_tokens=max_tokens,
+                concurrent_scoring=concurrent_scoring,
+            )
+
+        entity_probs = lookup_or_compute(feature_store, keys, compute_missing)
+        if return_log_probs:
+            return [tuple(x) for x in entity_probs]
+        return [tuple(x[:2]) for x in entity_probs]
+
+    n_inputs = len(masked_inputs)
+    prior_entity_probs: List[float] = [0.0] * n_inputs
+    posterior_entity_probs: List[float] = [0.0] * n_inputs
+    prior_entity_log_probs: List[float] = [0.0] * n_inputs
+    posterior_entity_log_probs: List[float] = [0.0] * n_inputs
+
+    if max_tokens is None:
+        batches_of_idxs = list(split_batches(list(range(n_inputs)), batch_size))
+    else:
+        batches_of_idxs = pack_batches_by_length(
+            posterior_input_lengths(
+                masked_inputs,
+                sources,
+                source_ids,
+                posterior_model_and_tokenizer[1],
+            ),
+            max_tokens,
+        )
+
+    if prior_mode not in ["masked", "causal", "shared_prefix"]:
+        raise ValueError(f"Unknown prior mode: {prior_mode}")
+
+    @torch.no_grad()
+    def score_priors():
+        if prior_mode == "causal":
+            (
+                prior_entity_probs[:],
+                prior_entity_log_probs[:],
+            ) = compute_causal_prior_probs(
+                masked_inputs,
+                targets,
+                entities,
+                prior_model_and_tokenizer,
+                device,
+                batch_size,
+                verbose,
+                scoring,
+            )
+            return
+        if prior_mode == "shared_prefix":
+            (
+                prior_entity_probs[:],
+                prior_entity_log_probs[:],
+            ) = compute_shared_prefix_prior_probs(
+                masked_inputs,
+                targets,
+                prior_model_and_tokenizer,
+                device,
+                batch_size,
+                scoring,
+            )
+            return
+        for batch_idxs in batches_of_idxs:
+            (
+                batch_prior_entity_probs,
+                batch_prior_entity_log_probs,
+            ) = compute_prior_probs_for_batch(
+                [masked_inputs[i] for i in batch_idxs],
+                [targets[i] for i in batch_idxs],
+                [entities[i] for i in batch_idxs],
+                prior_model_and_tokenizer,
+                device,
+                verbose,
+                scoring,
+            )
+            for i, idx in enumerate(batch_idxs):
+                prior_entity_probs[idx] = batch_prior_entity_probs[i]
+                prior_entity_log_probs[idx] = batch_prior_entity_log_probs[i]
+
+    @torch.no_grad()
+    def score_posteriors():
+        for batch_idxs in batches_of_idxs:
+            batch_masked_inputs = [masked_inputs[i] for i in batch_idxs]
+            batch_targets = [targets[i] for i in batch_idxs]
+
+            if verbose:
+                print(f"{batch_masked_inputs=}")
+                print(f"{batch_targets=}")
+
+            (
+                batch_posterior_entity_probs,
+                batch_posterior_entity_log_probs,
+            ) = compute_posterior_probs_for_batch(
+                batch_masked_inputs,
+                batch_targets,
+                [entities[i] for i in batch_idxs],
+                [sources[i] for i in batch_idxs],
+                (
+                    [source_ids[i] for i in batch_idxs]
+                    if source_ids is not None
+                    else None
+                ),
+                posterior_model_and_tokenizer,
+                prior_model_and_tokenizer[1],
+                device,
+                verbose,
+                scoring,
+            )
+            for i, idx in enumerate(batch_idxs):
+                posterior_entity_probs[idx] = batch_posterior_entity_probs[i]
+                posterior_entity_log_probs[idx] = batch_posterior_entity_log_probs[i]
+
+    if concurrent_scoring:
+        run_concurrently(score_priors, score_posteriors)
+    else:
+        score_priors()
+        score_posteriors()
+
+    if return_log_probs:
+        return list(
+            zip(
+                prior_entity_probs,
+                posterior_entity_probs,
+                prior_entity_log_probs,
+                posterior_entity_log_probs,
+            )
+        )
+    return list(zip(prior_entity_probs, posterior_entity_probs))
+
 
-    needed_data = list(zip(masked_inputs, targets, sources, entities))
-    inputs_batched = list(split_batches(needed_data, batch_size))
+def run_concurrently(prior_fn, posterior_fn):
+    """
+    Runs `prior_fn` in a worker thread and `posterior_fn` in the calling
+    thread.
 
-    for batch in inputs_batched:
-        batch_masked_inputs = [x[0] for x in batch]
-        batch_targets = [x[1] for x in batch]
-        batch_sources = [x[2] for x in batch]
-        batch_entities = [x[3] for x in batch]
+    torch's intra-op thread pool (`torch.set_num_threads`) is process-wide,
+    so both models share the same thread count: running them concurrently
+    only overlaps the parts that don't use the intra-op pool (tokenization,
+    Python overhead & waiting on the GPU), it doesn't split the CPU cores.
+    """
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        prior_future = executor.submit(prior_fn)
+        posterior_fn()
+        prior_future.result()
 
-        if verbose:
-            print(f"{batch_masked_inputs=}")
-            print(f"{batch_targets=}")
 
-        prior_input_batch_tokenized = prior_model_and_tokenizer[1](
-            batch_masked_inputs, return_tensors="pt", padding=True
-        ).to(device)
+def format_posterior_inputs(masked_inputs: List[str], sources: List[str]):
+    return [
+        "<s>" + masked_input.replace("<mask>", "###") + "</s>" + source
+        for masked_input, source in zip(masked_inputs, sources)
+    ]
 
-        batch_formatted_posterior_inputs = [
-            "<s>"
-            + batch_masked_inputs[i].replace("<mask>", "###")
-            + "</s>"
-            + batch_sources[i]
-            for i in range(len(batch_masked_inputs))
+
+def posterior_input_lengths(
+    masked_inputs: List[str],
+    sources: List[str],
+    source_ids: Optional[List[List[int]]],
+    tokenizer,
+) -> List[int]:
+    """
+    Number of (truncated) posterior input tokens of every input.
+    """
+    if source_ids is not None:
+        # same prefixes as `build_posterior_inputs_from_ids`
+        prefixes = tokenizer(
+            ["<s>" + x.replace("<mask>", "###") + "</s>" for x in masked_inputs],
+            add_special_tokens=False,
+        )["input_ids"]
+        return [
+            max(len(prefix), min(len(prefix) + len(ids), tokenizer.model_max_length))
+            for prefix, ids in zip(prefixes, source_ids)
         ]
+    return [
+        len(ids)
+        for ids in tokenizer(
+            format_posterior_inputs(masked_inputs, sources),
+            add_special_tokens=False,
+            truncation=True,
+        )["input_ids"]
+    ]
+
+
+def tokenize_targets_and_entities(
+    tokenizer, targets: List[str], entities: List[str], device
+) -> Tuple[BatchEncoding, BatchEncoding]:
+    target_tokenized = tokenizer(targets, return_tensors="pt", padding=True).to(
+        device
+    )
+
+    entities_with_leading_space = [" " + entity for entity in entities]
+
+    entity_tokenized = tokenizer(
+        entities_with_leading_space,
+        return_tensors="pt",
+        add_special_tokens=False,
+        padding=True,
+    ).to(device)
+    return target_tokenized, entity_tokenized
+
+
+def compute_prior_probs_for_batch(
+    masked_inputs: List[str],
+    targets: List[str],
+    entities: List[str],
+    prior_model_and_tokenizer,
+    device,
+    verbose: bool = False,
+    scoring: str = "teacher_forced",
+) -> Tuple[List[float], List[float]]:
+    """
+    Prior probabilities & log-probabilities of the masked entities,
+    NOT conditioned on the source.
+    """
+    prior_input_batch_tokenized = prior_model_and_tokenizer[1](
+        masked_inputs, return_tensors="pt", padding=True
+    ).to(device)
+    target_tokenized, entity_tokenized = tokenize_targets_and_entities(
+        prior_model_and_tokenizer[1], targets, entities, device
+    )
+    return compute_entitity_probability(
+        input_tokenized=prior_input_batch_tokenized,
+        target_tokenized=target_tokenized,
+        entity_tokenized=entity_tokenized,
+        model=prior_model_and_tokenizer[0],
+        tokenizer=prior_model_and_tokenizer[1],
+        verbose=verbose,
+        scoring=scoring,
+    )
+
+
+def compute_posterior_probs_for_batch(
+    masked_inputs: List[str],
+    targets: List[str],
+    entities: List[str],
+    sources: List[str],
+    source_ids: Optional[List[List[int]]],
+    posterior_model_and_tokenizer,
+    target_tokenizer,
+    device,
+    verbose: bool = False,
+    scoring: str = "teacher_forced",
+) -> Tuple[List[float], List[float]]:
+    """
+    Posterior probabilities & log-probabilities of the masked entities,
+    conditioned on the source.
+
+    Targets & entities are tokenized with `target_tokenizer`
+    (the prior model's tokenizer), which shares the posterior's vocab.
+    """
+    if source_ids is None:
+        batch_formatted_posterior_inputs = format_posterior_inputs(
+            masked_inputs, sources
+        )
 
         posterior_input_batch_tokenized = posterior_model_and_tokenizer[1](
             batch_formatted_posterior_inputs,
@@ -71,42 +396,258 @@ def compute_probs_for_summary(
             padding=True,
             return_tensors="pt",
         ).to(device)
-
-        target_tokenized = prior_model_and_tokenizer[1](
-            batch_targets, return_tensors="pt", padding=True
+    else:
+        posterior_input_batch_tokenized = build_posterior_inputs_from_ids(
+            masked_inputs,
+            source_ids,
+            posterior_model_and_tokenizer[1],
         ).to(device)
 
-        batch_entities_with_leading_space = [" " + entity for entity in batch_entities]
+    target_tokenized, entity_tokenized = tokenize_targets_and_entities(
+        target_tokenizer, targets, entities, device
+    )
+    return compute_entitity_probability(
+        input_tokenized=posterior_input_batch_tokenized,
+        target_tokenized=target_tokenized,
+        entity_tokenized=entity_tokenized,
+        model=posterior_model_and_tokenizer[0],
+        tokenizer=posterior_model_and_tokenizer[1],  # type: ignore
+        verbose=verbose,
+        scoring=scoring,
+    )
+
+
+def entity_span_from_masked_input(masked_input: str, target: str) -> Tuple[int, int]:
+    """
+    Character span of the entity in the target that was replaced by <mask>.
+    """
+    start = masked_input.index("<mask>")
+    end = start + len(target) - (len(masked_input) - len("<mask>"))
+    return start, end
+
+
+def causal_prior_inputs(
+    masked_inputs: List[str], targets: List[str]
+) -> Tuple[List[str], List[str]]:
+    """
+    Causal masked inputs & targets, as built by
+    `build_causal_masked_inputs_and_targets`: the summary to the left of
+    the entity followed by <mask>, and the summary up to the end of the entity.
+    """
+    causal_inputs, causal_targets = [], []
+    for masked_input, target in zip(masked_inputs, targets):
+        start, end = entity_span_from_masked_input(masked_input, target)
+        causal_inputs.append(masked_input[:start] + "<mask>")
+        causal_targets.append(target[:end])
+    return causal_inputs, causal_targets
+
+
+def compute_causal_prior_probs(
+    masked_inputs: List[str],
+    targets: List[str],
+    entities: List[str],
+    prior_model_and_tokenizer,
+    device,
+    batch_size: int = 3,
+    verbose: bool = False,
+    scoring: str = "teacher_forced",
+) -> Tuple[List[float], List[float]]:
+    """
+    Causal prior probabilities & log-probabilities of the masked entities,
+    i.e. conditioned only on the summary to the left of the entity, the
+    same as scoring the inputs of `build_causal_masked_inputs_and_targets`.
+
+    Inputs & targets are cut at the entity, so they're shorter than the
+    masked ones, and entities with the same left context (e.g. in the
+    unchanged prefix of a re-generated summary) are only scored once.
+    """
+    causal_inputs, causal_targets = causal_prior_inputs(masked_inputs, targets)
+    keys = list(zip(causal_inputs, causal_targets, entities))
+    unique_keys = list(dict.fromkeys(keys))
+    probs_by_key = {}
+    for batch_keys in split_batches(unique_keys, batch_size):
+        batch_probs, batch_log_probs = compute_prior_probs_for_batch(
+            [x[0] for x in batch_keys],
+            [x[1] for x in batch_keys],
+            [x[2] for x in batch_keys],
+            prior_model_and_tokenizer,
+            device,
+            verbose,
+            scoring,
+        )
+        probs_by_key.update(zip(batch_keys, zip(batch_probs, batch_log_probs)))
+    return (
+        [probs_by_key[key][0] for key in keys],
+        [probs_by_key[key][1] for key in keys],
+    )
+
 
-        entity_tokenized = prior_model_and_tokenizer[1](
-            batch_entities_with_leading_space,
+def compute_shared_prefix_prior_probs(
+    masked_inputs: List[str],
+    targets: List[str],
+    prior_model_and_tokenizer,
+    device,
+    batch_size: int = 3,
+    scoring: str = "teacher_forced",
+) -> Tuple[List[float], List[float]]:
+    """
+    Prior probabilities & log-probabilities of the masked entities given
+    only the summary to the left of the entity, with a single prior pass
+    per unique summary.
+
+    The encoder only sees <mask> and the decoder is forced on the full
+    summary, so every entity span is read off the same pass and prior cost
+    scales with the number of summaries instead of the number of entities.
+    This is a different probability from the "causal" prior mode, whose
+    encoder also sees the summary prefix (`build_causal_masked_inputs_and_targets`):
+    here the prefix is only decoder context.
+    """
+    model, tokenizer = prior_model_and_tokenizer
+    unique_targets = list(dict.fromkeys(targets))
+    input_idxs_by_target: Dict[str, List[int]] = {}
+    for input_idx, target in enumerate(targets):
+        input_idxs_by_target.setdefault(target, []).append(input_idx)
+
+    entity_log_probs: List[float] = [0.0] * len(masked_inputs)
+    for batch_targets in split_batches(unique_targets, batch_size):
+        target_tokenized = tokenizer(
+            batch_targets,
             return_tensors="pt",
-            add_special_tokens=False,
             padding=True,
+            return_offsets_mapping=True,
+        )
+        offsets = target_tokenized.pop("offset_mapping")
+        target_tokenized = target_tokenized.to(device)
+        encoder_input = tokenizer(
+            [tokenizer.mask_token] * len(batch_targets), return_tensors="pt"
         ).to(device)
+        target_logits = compute_target_logits(
+            encoder_input, target_tokenized, model, scoring
+        )
+        target_token_log_probs = (
+            target_logits.log_softmax(dim=-1)
+            .gather(2, target_tokenized["input_ids"].unsqueeze(-1))
+            .squeeze(-1)
+            .double()
+            .cpu()
+        )
 
-        with torch.no_grad():
-            batch_prior_entity_probs = compute_entitity_probability(
-                input_tokenized=prior_input_batch_tokenized,
-                target_tokenized=target_tokenized,
-                entity_tokenized=entity_tokenized,
-                model=prior_model_and_tokenizer[0],
-                tokenizer=prior_model_and_tokenizer[1],
-                verbose=verbose,
-            )
-            prior_entity_probs.extend(batch_prior_entity_probs)
-
-            batch_posterior_entity_probs = compute_entitity_probability(
-                input_tokenized=posterior_input_batch_tokenized,
-                target_tokenized=target_tokenized,
-                entity_tokenized=entity_tokenized,
-                model=posterior_model_and_tokenizer[0],
-                tokenizer=posterior_model_and_tokenizer[1],  # type: ignore
-                verbose=verbose,
-            )
-            posterior_entity_probs.extend(batch_posterior_entity_probs)
+        for idx_in_batch, target in enumerate(batch_targets):
+            token_starts = offsets[idx_in_batch, :, 0]
+            token_ends = offsets[idx_in_batch, :, 1]
+            for input_idx in input_idxs_by_target[target]:
+                start, end = entity_span_from_masked_input(
+                    masked_inputs[input_idx], target
+                )
+                # special tokens have empty offsets
+                is_entity_token = (
+                    (token_starts < end)
+                    & (token_ends > start)
+                    & (token_ends > token_starts)
+                )
+                entity_log_probs[input_idx] = (
+                    target_token_log_probs[idx_in_batch][is_entity_token].sum().item()
+                )
+
+    entity_probs = torch.tensor(entity_log_probs, dtype=torch.double).exp().tolist()
+    return entity_probs, entity_log_probs
+
+
+def build_posterior_inputs_from_ids(
+    masked_inputs: List[str], source_ids: List[List[int]], tokenizer
+) -> BatchEncoding:
+    """
+    Builds the same posterior inputs as tokenizing
+    `<s>{masked input}</s>{source}` with truncation, but reuses
+    pre-tokenized source ids instead of tokenizing the source again.
+    """
+    prefixes = tokenizer(
+        ["<s>" + x.replace("<mask>", "###") + "</s>" for x in masked_inputs],
+        add_special_tokens=False,
+    )["input_ids"]
+    return tokenizer.pad(
+        {
+            "input_ids": [
+                prefix + ids[: max(0, tokenizer.model_max_length - len(prefix))]
+                for prefix, ids in zip(prefixes, source_ids)
+            ]
+        },
+        return_tensors="pt",
+    )
 
-    return list(zip(prior_entity_probs, posterior_entity_probs))
+
+def compute_target_logits(
+    input_tokenized: BatchEncoding,
+    target_tokenized: BatchEncoding,
+    model,
+    scoring: str = "teacher_forced",
+) -> torch.Tensor:
+    """
+    Returns the logits of the model when decoding the target, with shape
+    (batch size x target length x vocab), where step i scores target token i.
+    """
+    target_input_ids = target_tokenized["input_ids"]
+
+    if scoring == "generate":
+
+        def prefix_allowed_tokens_fn(batch_id, input_ids):
+            current_step = len(input_ids) - 1
+            return target_input_ids[batch_id, current_step].tolist()
+
+        prediction = model.generate(
+            input_tokenized["input_ids"],
+            num_beams=1,
+            early_stopping=True,
+            return_dict_in_generate=True,
+            output_scores=True,
+            max_length=target_input_ids.shape[1] + 1,
+            prefix_allowed_tokens_fn=prefix_allowed_tokens_fn,
+        )
+        return torch.stack(prediction.scores, dim=1)
+    elif scoring == "teacher_forced":
+        decoder_input_ids = shift_tokens_right(
+            target_input_ids,
+            model.config.pad_token_id,
+            model.config.decoder_start_token_id,
+        )
+        return model(
+            input_ids=input_tokenized["input_ids"],
+            attention_mask=input_tokenized["attention_mask"],
+            decoder_input_ids=decoder_input_ids,
+        ).logits
+    else:
+        raise ValueError(f"Unknown scoring method: {scoring}")
+
+
+def gather_entity_log_probs(
+    target_logits: torch.Tensor,
+    mask_positions: torch.Tensor,
+    entity_input_ids: torch.Tensor,
+    entity_attention_mask: torch.Tensor,
+) -> torch.Tensor:
+    """
+    Joint log-probability of the entity tokens filled in at the mask
+    position of every row, gathered in one go from the
+    (batch size x target length x vocab) logits.
+    """
+    max_entity_length = entity_input_ids.shape[1]
+    # (batch size x max entity length) target positions of the entity tokens
+    entity_positions = mask_positions.unsqueeze(1) + torch.arange(
+        max_entity_length, device=target_logits.device
+    )
+    entity_positions = entity_positions.clamp(max=target_logits.shape[1] - 1)
+    entity_step_logits = target_logits.gather(
+        1,
+        entity_positions.unsqueeze(-1).expand(-1, -1, target_logits.shape[-1]),
+    )
+    entity_token_log_probs = (
+        entity_step_logits.log_softmax(dim=-1)
+        .gather(2, entity_input_ids.unsqueeze(-1))
+        .squeeze(-1)
+    )
+    return entity_token_log_probs.masked_fill(entity_attention_mask == 0, 0).sum(
+        dim=1
+    )
 
 
 def compute_entitity_probability(
@@ -116,50 +657,26 @@ def compute_entitity_probability(
     model,
     tokenizer,
     verbose: bool = False,
-) -> List[float]:
-
-    target_input_ids = target_tokenized["input_ids"]
+    scoring: str = "teacher_forced",
+) -> Tuple[List[float], List[float]]:
+    """
+    Returns the joint probabilities & log-probabilities of the masked entities.
+    """
 
-    def prefix_allowed_tokens_fn(batch_id, input_ids):
-        current_step = len(input_ids) - 1
-        return target_input_ids[batch_id, current_step].tolist()
-
-    prediction = model.generate(
-        input_tokenized["input_ids"],
-        num_beams=1,
-        early_stopping=True,
-        return_dict_in_generate=True,
-        output_scores=True,
-        max_length=target_input_ids.shape[1] + 1,
-        prefix_allowed_tokens_fn=prefix_allowed_tokens_fn,
-    )
-
-    mask_input_indices = (
-        input_tokenized["input_ids"] == tokenizer.mask_token_id
-    ).nonzero()
-    entity_token_lengths = entity_tokenized["attention_mask"].count_nonzero(dim=1)
-    mask_input_indices_with_length = torch.hstack(
-        (mask_input_indices, entity_token_lengths.unsqueeze(1))
-    )
-
-    probs_of_entity_tokens = []
-    for (
-        idx_in_batch,
-        starting_mask_token_pos,
-        num_entity_tokens,
-    ) in mask_input_indices_with_length:
-        entity_local_token_probs = []
-        for entity_local_idx in range(num_entity_tokens):
-            local_index_of_filled_in_token = starting_mask_token_pos + entity_local_idx
-            vocab_index_for_entity_token = entity_tokenized["input_ids"][idx_in_batch][
-                entity_local_idx
-            ]
+    target_logits = compute_target_logits(
+        input_tokenized, target_tokenized, model, scoring
+    )
 
-            prob_of_entity_token = prediction.scores[local_index_of_filled_in_token][
-                idx_in_batch
-            ].softmax(dim=0)[vocab_index_for_entity_token]
-            entity_local_token_probs.append(prob_of_entity_token)
-        probs_of_entity_tokens.append(entity_local_token_probs)
+    # position of the (first) mask token in every input
+    mask_positions = (
+        (input_tokenized["input_ids"] == tokenizer.mask_token_id).int().argmax(dim=1)
+    )
+    entity_log_probs = gather_entity_log_probs(
+        target_logits,
+        mask_positions,
+        entity_tokenized["input_ids"],
+        entity_tokenized["attention_mask"],
+    ).double()
 
     # if verbose:
     #     all_probs_at_target_tokens = [
@@ -171,41 +688,61 @@ def compute_entitity_probability(
     #     ]
     #     pprint.PrettyPrinter(indent=4).pprint(all_probs_at_target_tokens)
 
-    return [
-        torch.prod(torch.hstack(entity_probs)).item()
-        for entity_probs in probs_of_entity_tokens
-    ]
+    # exp in double precision so that long entities don't underflow to 0
+    return entity_log_probs.exp().tolist(), entity_log_probs.tolist()
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(
-        description="computes prior and posterior probabilities of specified split xent entities."
-    )
-    parser.add_argument("--verbose", type=bool, default=False)
-    parser.add_argument("--batch_size", type=int, default=8)
-    parser.add_argument(
-        "--num_examples",
-        type=int,
-        default=None,
-        help="debug: max number of examples to process",
-    )
-    parser.add_argument(
-        "--entity_input_filepath",
-        type=str,
-        help="filepath to read existing prob output from",
-    )
-    parser.add_argument(
-        "--entity_with_probs_output_filepath",
-        type=str,
-        help="filepath to write prob output to",
+def shard_output_filepath(output_filepath: str, shard_idx: int, num_shards: int):
+    if num_shards == 1:
+        return output_filepath + ".jsonl"
+    return f"{output_filepath}.shard-{shard_idx}-of-{num_shards}.jsonl"
+
+
+def prefill_token_cache(args):
+    dataset = json.load(open(args.entity_input_filepath))
+    tokenizer = load_bart_xsum_cmlm_tokenizer()
+    sources = list(dict.fromkeys(example["source"] for example in dataset))
+    TokenizationCache(args.token_cache_dir).get_or_tokenize(
+        tokenizer, [source_hash(x) for x in sources], sources
     )
-    args = parser.parse_args()
+
+
+def compute_probs_for_shard(
+    args, shard_idx: int = 0, num_shards: int = 1, num_threads: Optional[int] = None
+):
+    """
+    Computes probabilities for the examples with idx % num_shards == shard_idx,
+    appending them to the shard's own JSONL file.
+    """
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
     dataset = json.load(open(args.entity_input_filepath))
+    writer = JsonlAppendWriter(
+        shard_output_filepath(
+            args.entity_with_probs_output_filepath, shard_idx, num_shards
+        ),
+        resume=args.resume,
+        fsync_every=args.fsync_every,
+    )
+    if args.resume:
+        print(f"Resuming, skipping {len(writer.done)} processed examples")
 
     prior_model_and_tokenizer = load_prior_model_and_tokenizer("facebook/bart-large")
     posterior_model_and_tokenizer = load_bart_xsum_cmlm()
+    token_cache = (
+        TokenizationCache(args.token_cache_dir) if args.token_cache_dir else None
+    )
+    feature_store = (
+        ProbFeatureStore(args.feature_store_path) if args.feature_store_path else None
+    )
 
-    for idx, example in enumerate(tqdm(dataset)):
+    shard_idxs = [
+        idx
+        for idx in range(len(dataset))
+        if idx % num_shards == shard_idx and idx not in writer.done
+    ]
+    for idx in tqdm(shard_idxs, position=shard_idx):
+        example = dataset[idx]
         (
             inputs,
             targets,
@@ -214,6 +751,14 @@ if __name__ == "__main__":
             entity_labels,
         ) = build_masked_inputs_and_targets(example)
 
+        source_ids = None
+        if token_cache is not None and len(sources) > 0:
+            source_ids = token_cache.get_or_tokenize(
+                posterior_model_and_tokenizer[1],
+                [source_hash(x) for x in sources],
+                sources,
+            )
+
         entity_probs = compute_probs_for_summary(
             masked_inputs=inputs,
             targets=targets,
@@ -222,17 +767,166 @@ if __name__ == "__main__":
             batch_size=args.batch_size,
             prior_model_and_tokenizer=prior_model_and_tokenizer,
             posterior_model_and_tokenizer=posterior_model_and_tokenizer,
+            source_ids=source_ids,
+            return_log_probs=True,
+            prior_mode=args.prior_mode,
+            feature_store=feature_store,
+            max_tokens=args.max_tokens,
+            concurrent_scoring=args.concurrent_scoring,
+            source_window_tokens=args.source_window_tokens,
         )
 
-        persist_example_with_probs(
-            output_filepath=args.entity_with_probs_output_filepath,
-            output_dataset=dataset,
-            output_dataset_idx=idx,
-            example=example,
-            entity_texts=entities,
-            entity_probs=entity_probs,
-        )
+        writer.write(idx, add_probs_to_example(example, entities, entity_probs))
 
         # pprint.PrettyPrinter(indent=4).pprint(
         #     list(zip(entities, entity_labels, entity_probs))
         # )
+
+    writer.close()
+
+    if feature_store is not None:
+        print(f"Feature store hit rate: {feature_store.hit_rate():.2%}")
+
+
+def merge_shards(args, num_shards: int):
+    """
+    Merges the shard outputs into the output JSON file, in dataset order.
+    """
+    dataset = json.load(open(args.entity_input_filepath))
+    compact_jsonl_examples(
+        [
+            shard_output_filepath(
+                args.entity_with_probs_output_filepath, shard_idx, num_shards
+            )
+            for shard_idx in range(num_shards)
+        ],
+        args.entity_with_probs_output_filepath,
+        dataset,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="computes prior and posterior probabilities of specified split xent entities."
+    )
+    parser.add_argument("--verbose", type=bool, default=False)
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument(
+        "--num_examples",
+        type=int,
+        default=None,
+        help="debug: max number of examples to process",
+    )
+    parser.add_argument(
+        "--entity_input_filepath",
+        type=str,
+        help="filepath to read existing prob output from",
+    )
+    parser.add_argument(
+        "--entity_with_probs_output_filepath",
+        type=str,
+        help="filepath to write prob output to",
+    )
+    parser.add_argument(
+        "--max_tokens",
+        type=int,
+        default=None,
+        help="batch length-sorted inputs by max padded posterior tokens "
+        + "instead of --batch_size",
+    )
+    parser.add_argument(
+        "--concurrent_scoring",
+        action="store_true",
+        help="score priors & posteriors in concurrent threads, which share "
+        + "torch's process-wide intra-op threads",
+    )
+    parser.add_argument(
+        "--source_window_tokens",
+        type=int,
+        default=None,
+        help="only keep the source sentences most overlapping with the masked "
+        + "summary & entity, up to this many tokens, for the posterior",
+    )
+    parser.add_argument(
+        "--prior_mode",
+        type=str,
+        default="masked",
+        help="masked|causal|shared_prefix: causal conditions the prior on "
+        + "the summary to the left of the entity only, shared_prefix scores "
+        + "all entities of a summary in one pass with the prefix as decoder "
+        + "context only (a different probability from causal)",
+    )
+    parser.add_argument(
+        "--token_cache_dir",
+        type=str,
+        default="",
+        help="directory for caching tokenized sources across runs",
+    )
+    parser.add_argument(
+        "--feature_store_path",
+        type=str,
+        default="",
+        help="SQLite file for storing entity probabilities across runs",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="skip examples already written by a previous run",
+    )
+    parser.add_argument(
+        "--fsync_every",
+        type=int,
+        default=50,
+        help="number of examples between fsyncs of the JSONL output",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=1,
+        help="number of worker processes, each scoring its own shard of examples",
+    )
+    parser.add_argument(
+        "--shard",
+        type=str,
+        default="",
+        help="i/N: only process the i-th of N shards (e.g. on different machines)",
+    )
+    parser.add_argument(
+        "--merge_shards",
+        type=int,
+        default=0,
+        help="merge the outputs of N shards into the output file and exit",
+    )
+    args = parser.parse_args()
+
+    if args.merge_shards > 0:
+        merge_shards(args, args.merge_shards)
+    elif args.shard:
+        shard_idx, num_shards = [int(x) for x in args.shard.split("/")]
+        compute_probs_for_shard(args, shard_idx, num_shards)
+    elif args.num_workers > 1:
+        if args.token_cache_dir:
+            # Tokenize all sources up front so that the workers only read the cache
+            prefill_token_cache(args)
+        num_threads = max(1, (os.cpu_count() or 1) // args.num_workers)
+        mp_context = torch.multiprocessing.get_context("spawn")
+        workers = [
+            mp_context.Process(
+                target=compute_probs_for_shard,
+                args=(args, shard_idx, args.num_workers, num_threads),
+            )
+            for shard_idx in range(args.num_workers)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        failed = [i for i, worker in enumerate(workers) if worker.exitcode != 0]
+        if len(failed) > 0:
+            raise RuntimeError(
+                f"Workers of shards {failed} failed, rerun with --resume"
+            )
+        merge_shards(args, args.num_workers)
+    else:
+        compute_probs_for_shard(args)
+        merge_shards(args, 1)
@@ -0,0 +1,59 @@
+import argparse
+import pickle
+
+import numpy as np
+
+from src.entity_factuality import (
+    FEATURE_COLUMNS,
+    posterior_grid,
+    prior_only_predictions,
+)
+from train_factuality_clf import build_test_features_and_targets, load_features
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="evaluates the prior-first classifier cascade on stored probs"
+    )
+    parser.add_argument(
+        "--test_data_filepath", type=str, default="data/xent-probs/test.json"
+    )
+    parser.add_argument(
+        "--pickled_classifier",
+        type=str,
+        default="factuality-classifiers/v2-knn-20n.pickle",
+    )
+    parser.add_argument(
+        "--thresholds", type=str, default="0.6,0.7,0.8,0.9,1.0", help="comma separated"
+    )
+    parser.add_argument(
+        "--test_only_on_hallucinated",
+        default=False,
+        action="store_true",
+        help="only evaluate on hallucinated entities, "
+        + "which are the ones classified during GEF",
+    )
+    args = parser.parse_args()
+
+    with open(args.pickled_classifier, "rb") as f:
+        clf = pickle.load(f)
+    features, targets = build_test_features_and_targets(
+        load_features(args.test_data_filepath),
+        ignore_intrinsic=True,
+        test_only_on_hallucinated=args.test_only_on_hallucinated,
+    )
+    features = features[FEATURE_COLUMNS].astype(float).reset_index(drop=True)
+    full_predictions = clf.predict(features)
+
+    grid = posterior_grid(clf)
+    print(f"{len(features)} entities")
+    for threshold in [float(x) for x in args.thresholds.split(",")]:
+        predictions = prior_only_predictions(clf, features, threshold, grid)
+        is_avoided = predictions != -1
+        cascade_predictions = np.where(is_avoided, predictions, full_predictions)
+        print(
+            f"threshold {threshold}: "
+            + f"{is_avoided.mean():.2%} posterior calls avoided, "
+            + f"{(cascade_predictions == full_predictions).mean():.2%} label agreement, "
+            + f"accuracy {(cascade_predictions == targets.to_numpy()).mean():.2%} "
+            + f"(full: {(full_predictions == targets.to_numpy()).mean():.2%})"
+        )
@@ -2,8 +2,8 @@ import argparse
 from typing import Union
 from src.oracle import EntityMatchType
 from src.evaluation.factuality import evaluate_factuality
-from src.generation_utils import SUMMARY_FAILED_GENERATION
 from src.data_utils import (
+    SUMMARY_FAILED_GENERATION,
     get_gold_xsum_data,
     load_shuffled_test_split,
     load_xsum_dict,
@@ -0,0 +1,117 @@
+import argparse
+import json
+import pickle
+import time
+
+import numpy as np
+import pandas as pd
+
+from compute_probs import compute_probs_for_summary
+from src.generation_utils import load_bart_xsum_cmlm, load_prior_model_and_tokenizer
+from src.prob_computation_utils import build_masked_inputs_and_targets
+
+
+def score(inputs, prior_model_and_tokenizer, posterior_model_and_tokenizer, **kwargs):
+    start_time = time.time()
+    entity_probs = compute_probs_for_summary(
+        masked_inputs=inputs[0],
+        targets=inputs[1],
+        entities=inputs[2],
+        sources=inputs[3],
+        prior_model_and_tokenizer=prior_model_and_tokenizer,
+        posterior_model_and_tokenizer=posterior_model_and_tokenizer,
+        **kwargs,
+    )
+    return time.time() - start_time, np.array(entity_probs)
+
+
+def predict_labels(clf, entity_probs, overlaps):
+    return clf.predict(
+        pd.DataFrame(
+            {
+                "prior_prob": entity_probs[:, 0],
+                "posterior_prob": entity_probs[:, 1],
+                "overlaps_source": overlaps,
+            }
+        )
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="evaluates source windowing for posterior entity probabilities"
+    )
+    parser.add_argument(
+        "--entity_input_filepath", type=str, default="data/xent-probs/test.json"
+    )
+    parser.add_argument(
+        "--pickled_classifier",
+        type=str,
+        default="factuality-classifiers/v2-knn-20n.pickle",
+    )
+    parser.add_argument("--num_examples", type=int, default=50)
+    parser.add_argument("--batch_size", type=int, default=3)
+    parser.add_argument("--source_window_tokens", type=int, default=256)
+    args = parser.parse_args()
+
+    with open(args.entity_input_filepath, "r") as f:
+        dataset = json.load(f)[: args.num_examples]
+    with open(args.pickled_classifier, "rb") as f:
+        clf = pickle.load(f)
+
+    masked_inputs, targets, entities, sources, overlaps = [], [], [], [], []
+    for example in dataset:
+        (
+            example_inputs,
+            example_targets,
+            example_entities,
+            example_sources,
+            example_labels,
+        ) = build_masked_inputs_and_targets(example)
+        masked_inputs.extend(example_inputs)
+        targets.extend(example_targets)
+        entities.extend(example_entities)
+        sources.extend(example_sources)
+        overlaps.extend([label == "Non-hallucinated" for label in example_labels])
+    inputs = (masked_inputs, targets, entities, sources)
+
+    prior_model_and_tokenizer = load_prior_model_and_tokenizer("facebook/bart-large")
+    posterior_model_and_tokenizer = load_bart_xsum_cmlm()
+
+    full_time, full_probs = score(
+        inputs,
+        prior_model_and_tokenizer,
+        posterior_model_and_tokenizer,
+        batch_size=args.batch_size,
+        return_log_probs=True,
+    )
+    windowed_time, windowed_probs = score(
+        inputs,
+        prior_model_and_tokenizer,
+        posterior_model_and_tokenizer,
+        batch_size=args.batch_size,
+        return_log_probs=True,
+        source_window_tokens=args.source_window_tokens,
+    )
+
+    posterior_diff = np.abs(full_probs[:, 1] - windowed_probs[:, 1])
+    log_posterior_diff = np.abs(full_probs[:, 3] - windowed_probs[:, 3])
+    label_agreement = np.mean(
+        predict_labels(clf, full_probs, overlaps)
+        == predict_labels(clf, windowed_probs, overlaps)
+    )
+
+    print(
+        f"{len(masked_inputs)} entities, "
+        + f"source window of {args.source_window_tokens} tokens"
+    )
+    print(
+        f"Full source: {full_time:.2f}s, windowed: {windowed_time:.2f}s "
+        + f"({full_time / windowed_time:.2f}x speedup)"
+    )
+    print(
+        f"Posterior prob abs change: mean {posterior_diff.mean():.4f}, "
+        + f"max {posterior_diff.max():.4f}"
+    )
+    print(f"Posterior log-prob abs change: mean {log_posterior_diff.mean():.4f}")
+    print(f"kNN label agreement: {label_agreement:.2%}")
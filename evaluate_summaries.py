@@ -4,7 +4,7 @@ from src.data_utils import (
     load_xsum_dict,
     load_summaries_from_logs,
 )
-from src.detect_entities import detect_entities
+from src.detect_entities import configure_ner_cache, detect_entities_batch
 from src.evaluation.factuality import evaluate_factuality
 from sumtool.storage import get_summary_metrics, get_summaries
 import argparse
@@ -73,7 +73,15 @@ if __name__ == "__main__":
     parser.add_argument("--print_first_n", type=int, default=0)
     parser.add_argument("--model_filter", type=str, default="")
     parser.add_argument("--count_skips", type=bool, default=False)
+    parser.add_argument("--ner_n_process", type=int, default=1)
+    parser.add_argument(
+        "--ner_cache_path",
+        type=str,
+        default="",
+        help="SQLite file caching detected entities by summary text",
+    )
     args = parser.parse_args()
+    configure_ner_cache(args.ner_cache_path)
 
     baseline_metadata = get_summary_metrics("xsum", "facebook-bart-large-xsum")
     gold_sums, gold_metadata = get_gold_xsum_data()
@@ -132,13 +140,22 @@ if __name__ == "__main__":
                     for sum_id, x in sum_ents_by_id.items()
                     if sum_id in test_set_ids
                 }
+                # Detect entities if they're not cached
+                missing_ids = [
+                    sum_id
+                    for sum_id in filtered_sums_by_id.keys()
+                    if sum_id not in filtered_ents_by_id
+                ]
+                detected_entities = detect_entities_batch(
+                    [
+                        (filtered_sums_by_id[sum_id], xsum_test[sum_id]["document"])
+                        for sum_id in missing_ids
+                    ],
+                    n_process=args.ner_n_process,
+                )
+                filtered_ents_by_id.update(zip(missing_ids, detected_entities))
                 for sum_id, sum in filtered_sums_by_id.items():
                     if sum not in unique_sums:
-                        # Detect entities if they're not cached
-                        if sum_id not in filtered_ents_by_id:
-                            filtered_ents_by_id[sum_id] = detect_entities(
-                                sum, xsum_test[sum_id]["document"]
-                            )
                         unique_sums.add(sum)
                         unique_sum_ent_count += len(filtered_ents_by_id[sum_id])
                 print(f"Model: {model_label}")
@@ -1,30 +1,27 @@
 from collections import defaultdict
 import argparse
 from src.data_utils import (
+    SUMMARY_FAILED_GENERATION,
     load_debug_subset,
     load_shuffled_test_split,
     load_xsum_dict,
     split_batches,
 )
-from src.detect_entities import detect_entities
+from src.detect_entities import (
+    configure_ner_cache,
+    configure_nlp,
+    detect_entities_batch,
+)
 from copy import deepcopy
 from src.entity_utils import (
+    ANNOTATION_LABELS,
     count_entities,
     filter_entities,
 )
-from src.entity_factuality import (
-    EntityFactualityClassifier,
-    ANNOTATION_LABELS,
-)
-from src.generation_utils import (
-    SUMMARY_FAILED_GENERATION,
-    generate_summaries,
-    load_model_and_tokenizer,
-)
-from src.beam_validators import BannedPhrases
-from src.word_logits_processor import WordLogitsProcessor
-from sumtool.storage import get_summary_metrics
 from src.misc_utils import Timer, get_new_log_path
+from src.feature_store import ProbFeatureStore
+from src.token_cache import TokenizationCache
+from src.pipeline import PipelineStage, StagedPipeline
 import json
 import time
 from src.oracle import oracle_label_entities, get_entity_annotations
@@ -161,10 +158,192 @@ def print_results(label, results_by_sum_id, type="summary"):
         )
 
 
+def prepare_batch(
+    batch_sources,
+    banned_phrases_by_sum_id,
+    tokenizer,
+    token_cache,
+    length_budget_by_sum_id=None,
+    baseline=None,
+):
+    """
+    Tokenization stage: tokenizes the batch (from the `token_cache` if set)
+    & collects constraints & length budgets, so that tokenizing batch k+1
+    overlaps with generating batch k.
+
+    With `baseline` summaries from sumtool storage (warm start), the stored
+    summaries of the batch & their number of tokens are collected too. All
+    tokenizer calls stay in this stage: fast tokenizers change their
+    truncation settings on every call, so they can't be shared across stages.
+    """
+    from src.generation_utils import tokenize_docs
+
+    id_to_idx = {}
+    model_input = []
+    banned_phrases_by_input_idx = {}
+    for sum_id, source in batch_sources:
+        input_idx = len(model_input)
+        id_to_idx[sum_id] = input_idx
+        model_input.append(source)
+        banned_phrases_by_input_idx[input_idx] = set(banned_phrases_by_sum_id[sum_id])
+
+    model_input_ids = None
+    if token_cache is not None:
+        model_input_ids = token_cache.get_or_tokenize(
+            tokenizer, list(id_to_idx.keys()), model_input
+        )
+    max_lengths = None
+    if length_budget_by_sum_id is not None:
+        max_lengths = [length_budget_by_sum_id(sum_id) for sum_id in id_to_idx.keys()]
+    baseline_by_id = {}
+    if baseline is not None:
+        baseline_summaries = {
+            sum_id: baseline[sum_id]["summary"]
+            for sum_id in id_to_idx.keys()
+            if sum_id in baseline
+        }
+        if len(baseline_summaries) > 0:
+            baseline_ids = tokenizer(list(baseline_summaries.values())).input_ids
+            for (sum_id, summary), ids in zip(baseline_summaries.items(), baseline_ids):
+                # + 1 for the decoder start token
+                baseline_by_id[sum_id] = {
+                    "summary": summary,
+                    "num_tokens": len(ids) + 1,
+                }
+    return {
+        "sources_by_id": {k: v for k, v in batch_sources},
+        "id_to_idx": id_to_idx,
+        "model_input": model_input,
+        "model_inputs": tokenize_docs(tokenizer, model_input, model_input_ids),
+        "banned_phrases_by_input_idx": banned_phrases_by_input_idx,
+        "max_lengths": max_lengths,
+        "baseline_by_id": baseline_by_id,
+    }
+
+
+def generate_batch(batch, model, tokenizer, num_beams, generation_cache):
+    """
+    Generation stage: runs constrained beam search for a batch,
+    skipping inputs that are in the generation cache.
+
+    Baseline summaries collected by `prepare_batch` are used instead
+    (warm start); their entities are detected again by the detection
+    stage, so that `in_source` matches the current detector. Docs missing
+    from the baseline are still generated.
+    """
+    from src.generation_cache import generate_summaries_with_cache
+    from src.generation_utils import select_inputs
+
+    n_inputs = len(batch["model_input"])
+    gen_summaries = [None] * n_inputs
+    generation_metadata = [None] * n_inputs
+    for sum_id, baseline_summary in batch["baseline_by_id"].items():
+        input_idx = batch["id_to_idx"][sum_id]
+        gen_summaries[input_idx] = baseline_summary["summary"]
+        generation_metadata[input_idx] = {
+            "score": None,
+            "dropped_seqs": [],
+            "n_words_checked": 0,
+            "num_tokens": baseline_summary["num_tokens"],
+        }
+
+    missing_idxs = [idx for idx, summary in enumerate(gen_summaries) if summary is None]
+    if len(missing_idxs) > 0:
+        with Timer(f"Generating {len(missing_idxs)} summaries"):
+            missing_summaries, missing_metadata = generate_summaries_with_cache(
+                generation_cache,
+                model,
+                tokenizer,
+                [batch["model_input"][idx] for idx in missing_idxs],
+                {
+                    local_idx: batch["banned_phrases_by_input_idx"][idx]
+                    for local_idx, idx in enumerate(missing_idxs)
+                },
+                num_beams=num_beams,
+                inputs=select_inputs(batch["model_inputs"], missing_idxs),
+                max_lengths=(
+                    [batch["max_lengths"][idx] for idx in missing_idxs]
+                    if batch["max_lengths"] is not None
+                    else None
+                ),
+            )
+        for local_idx, idx in enumerate(missing_idxs):
+            gen_summaries[idx] = missing_summaries[local_idx]
+            generation_metadata[idx] = missing_metadata[local_idx]
+
+    batch["generation_metadata"] = generation_metadata
+    batch["gen_summaries_by_id"] = {
+        bbc_id: gen_summaries[input_idx]
+        for bbc_id, input_idx in batch["id_to_idx"].items()
+    }
+    return batch
+
+
+def detect_batch_entities(batch):
+    """
+    Detection stage: detects the entities of every generated summary.
+    """
+    with Timer("Detecting entities"):
+        sum_ids = list(batch["gen_summaries_by_id"].keys())
+        detected_entities = detect_entities_batch(
+            [
+                (batch["gen_summaries_by_id"][bbc_id], batch["sources_by_id"][bbc_id])
+                for bbc_id in sum_ids
+            ]
+        )
+    batch["summary_entities"] = dict(zip(sum_ids, detected_entities))
+    return batch
+
+
+def oracle_label_batch(batch, summary_gold_metadata, entity_label_match):
+    summary_entities = batch["summary_entities"]
+    batch["oracle_labeled_entities"] = oracle_label_entities(
+        summary_entities,
+        get_entity_annotations(summary_entities.keys(), summary_gold_metadata),
+        entity_label_match,
+    )
+    return batch
+
+
+def label_batch(batch, clf_factuality, summary_gold_metadata, entity_label_match):
+    """
+    Labeling stage: detects entities, classifies them & sets oracle labels.
+
+    Without a `clf_factuality`, entities aren't classified here
+    (e.g. when they're classified across batches by an `EntityClassificationQueue`).
+    """
+    batch = detect_batch_entities(batch)
+
+    # Set predicted labels from classifier
+    if clf_factuality is not None:
+        with Timer("Classifying entities"):
+            batch["summary_entities"] = clf_factuality.classify_entities(
+                batch["summary_entities"],
+                batch["gen_summaries_by_id"],
+                batch["sources_by_id"],
+            )
+
+    # Set labels from oracle
+    return oracle_label_batch(batch, summary_gold_metadata, entity_label_match)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--pickled_classifier", type=str, default="")
     parser.add_argument("--classifier_batch_size", type=int, default=4)
+    parser.add_argument(
+        "--classifier_cascade_threshold",
+        type=float,
+        default=None,
+        help="only compute posteriors when the prior-only kNN vote is below this",
+    )
+    parser.add_argument(
+        "--classifier_queue_size",
+        type=int,
+        default=0,
+        help="classify entities across generation batches once this many "
+        + "extrinsic entities are queued (0: classify every batch)",
+    )
     parser.add_argument("--entity_label_match", type=str, default="strict_extrinsic")
     parser.add_argument(
         "--model_summarization", type=str, default="facebook/bart-large-xsum"
@@ -177,18 +356,99 @@ if __name__ == "__main__":
     parser.add_argument("--batch_size", type=int, default=2)
     parser.add_argument("--test_size", type=int, default=100)
     parser.add_argument("--num_beams", type=int, default=4)
+    parser.add_argument("--spacy_tier", type=str, default="lg", help="sm|md|lg")
     parser.add_argument(
         "--data_subset", type=str, default="debug", help="debug|xent|full"
     )
+    parser.add_argument(
+        "--length_budget_slack",
+        type=int,
+        default=None,
+        help="decode at most this many tokens more than the summary of the "
+        + "previous iteration (unset decodes up to the model's max_length)",
+    )
+    parser.add_argument(
+        "--warm_start",
+        default=False,
+        action="store_true",
+        help="take the summaries of iteration 0 from the stored "
+        + "unconstrained baseline of the summarization model in sumtool",
+    )
+    parser.add_argument(
+        "--pipeline_queue_size",
+        type=int,
+        default=0,
+        help="overlap tokenization, generation & labeling of consecutive batches "
+        + "with queues of this size (0 runs the stages sequentially)",
+    )
+    parser.add_argument(
+        "--generation_cache_dir",
+        type=str,
+        default="",
+        help="directory for caching generated summaries across runs",
+    )
+    parser.add_argument("--generation_cache_max_size_mb", type=float, default=1024)
+    parser.add_argument(
+        "--feature_store_path",
+        type=str,
+        default="",
+        help="SQLite file storing entity probs across iterations & runs",
+    )
+    parser.add_argument(
+        "--token_cache_dir",
+        type=str,
+        default="",
+        help="directory for caching tokenized sources across iterations & runs",
+    )
+    parser.add_argument(
+        "--ner_cache_path",
+        type=str,
+        default="",
+        help="SQLite file caching detected entities by summary text",
+    )
     args = parser.parse_args()
+    # torch, transformers & sumtool are only imported once the arguments
+    # are parsed, so that --help & argument errors return immediately
+    from src.entity_factuality import (
+        EntityClassificationQueue,
+        EntityFactualityClassifier,
+    )
+    from src.generation_utils import load_model_and_tokenizer
+    from src.generation_cache import GenerationCache
+    from sumtool.storage import get_summaries, get_summary_metrics
+
+    configure_nlp(args.spacy_tier)
+    ner_cache = configure_ner_cache(args.ner_cache_path)
     num_beams = args.num_beams
     with Timer("Loading summarization model & dataset"):
         model, tokenizer = load_model_and_tokenizer(args.model_summarization)
         iteration_log = {}
         logging_path = get_new_log_path("logs-iterative") + ".json"
         summary_gold_metadata = get_summary_metrics("xsum", "gold")
-        baseline_metadata = get_summary_metrics("xsum", "facebook-bart-large-xsum")
+        if args.warm_start:
+            # A local checkpoint or a model without a stored baseline can only
+            # be run without warm start
+            baseline = get_summaries(
+                "xsum", args.model_summarization.replace("/", "-")
+            )
+        else:
+            baseline = None
         xsum_test = load_xsum_dict("test")
+        token_cache = (
+            TokenizationCache(args.token_cache_dir) if args.token_cache_dir else None
+        )
+        generation_cache = (
+            GenerationCache(
+                args.generation_cache_dir, args.generation_cache_max_size_mb
+            )
+            if args.generation_cache_dir
+            else None
+        )
+        feature_store = (
+            ProbFeatureStore(args.feature_store_path)
+            if args.feature_store_path
+            else None
+        )
 
     if args.pickled_classifier != "":
         clf_factuality = EntityFactualityClassifier(
@@ -196,10 +456,19 @@ if __name__ == "__main__":
             args.model_prior,
             args.model_posterior,
             args.classifier_batch_size,
+            token_cache,
+            feature_store,
+            args.classifier_cascade_threshold,
         )
     else:
         clf_factuality = None
 
+    classification_queue = (
+        EntityClassificationQueue(clf_factuality, args.classifier_queue_size)
+        if clf_factuality is not None and args.classifier_queue_size > 0
+        else None
+    )
+
     xent_test_summaries = {
         sum_id: x["document"]
         for sum_id, x in xsum_test.items()
@@ -219,6 +488,24 @@ if __name__ == "__main__":
     # initialize with no constraints
     banned_phrases_by_sum_id = defaultdict(lambda: set())
 
+    # Decode with a length budget based on the previous summary's length
+    num_tokens_by_sum_id = {}
+
+    def length_budget(sum_id):
+        if sum_id not in num_tokens_by_sum_id:
+            return model.config.max_length
+        return min(
+            max(
+                num_tokens_by_sum_id[sum_id] + args.length_budget_slack,
+                model.config.min_length + 1,
+            ),
+            model.config.max_length,
+        )
+
+    length_budget_by_sum_id = (
+        length_budget if args.length_budget_slack is not None else None
+    )
+
     should_prompt_labeling = args.annotate
 
     # ...until convergence / max iterations
@@ -246,67 +533,76 @@ if __name__ == "__main__":
         ]
         batches = list(split_batches(incomplete_docs, args.batch_size))
         with Timer(f"Iteration {n_iterations}, {len(incomplete_docs)} docs"):
-            for batch_idx, batch_sources in enumerate(batches):
-                print(f"Batch {batch_idx+1}/{len(batches)}")
-                # Generate summaries
-                id_to_idx = {}
-                model_input = []
-                banned_phrases_by_input_idx = {}
-                for sum_id, source in batch_sources:
-                    input_idx = len(model_input)
-                    id_to_idx[sum_id] = input_idx
-                    model_input.append(source)
-                    banned_phrases_by_input_idx[input_idx] = banned_phrases_by_sum_id[
-                        sum_id
-                    ]
-
-                factuality_enforcer = WordLogitsProcessor(
-                    tokenizer,
-                    num_beams,
-                    BannedPhrases(
-                        banned_phrases_by_input_idx=banned_phrases_by_input_idx
+            pipeline = StagedPipeline(
+                [
+                    PipelineStage(
+                        "tokenize",
+                        lambda batch_sources: prepare_batch(
+                            batch_sources,
+                            banned_phrases_by_sum_id,
+                            tokenizer,
+                            token_cache,
+                            length_budget_by_sum_id,
+                            # Iteration 0 is unconstrained, same as the baseline
+                            baseline if n_iterations == 0 else None,
+                        ),
                     ),
-                )
-                with Timer(f"Generating {len(model_input)} summaries"):
-                    gen_summaries, generation_metadata = generate_summaries(
-                        model,
-                        tokenizer,
-                        model_input,
-                        factuality_enforcer,
-                        num_beams=num_beams,
-                        return_beam_metadata=True,
+                    PipelineStage(
+                        "generate",
+                        lambda batch: generate_batch(
+                            batch,
+                            model,
+                            tokenizer,
+                            num_beams,
+                            generation_cache,
+                        ),
+                    ),
+                    PipelineStage(
+                        "label",
+                        lambda batch: (
+                            label_batch(
+                                batch,
+                                clf_factuality,
+                                summary_gold_metadata,
+                                args.entity_label_match,
+                            )
+                            if classification_queue is None
+                            else detect_batch_entities(batch)
+                        ),
+                    ),
+                ],
+                # Manual annotation needs the stages to run in lockstep
+                queue_size=0 if should_prompt_labeling else args.pipeline_queue_size,
+            )
+
+            def labeled_batches():
+                if classification_queue is None:
+                    yield from pipeline.run(batches)
+                    return
+                for batch in pipeline.run(batches):
+                    for ready_batch in classification_queue.push(batch):
+                        yield oracle_label_batch(
+                            ready_batch, summary_gold_metadata, args.entity_label_match
+                        )
+                # classify the rest at the end of the iteration
+                for ready_batch in classification_queue.flush():
+                    yield oracle_label_batch(
+                        ready_batch, summary_gold_metadata, args.entity_label_match
                     )
-                gen_summaries_by_id = {
-                    bbc_id: gen_summaries[input_idx]
-                    for bbc_id, input_idx in id_to_idx.items()
-                }
+
+            for batch_idx, batch in enumerate(labeled_batches()):
+                print(f"Batch {batch_idx+1}/{len(batches)}")
+                id_to_idx = batch["id_to_idx"]
+                generation_metadata = batch["generation_metadata"]
+                gen_summaries_by_id = batch["gen_summaries_by_id"]
+                oracle_labeled_entities = batch["oracle_labeled_entities"]
                 for sum_id, summary in gen_summaries_by_id.items():
                     results_by_sum_id[sum_id]["summary"] = summary
-
-                #  Detect & classify entities
-                with Timer("Detecting & classifying entities"):
-                    summary_entities = {}
-                    for bbc_id, input_idx in id_to_idx.items():
-                        summary_entities[bbc_id] = detect_entities(
-                            gen_summaries[input_idx], model_input[input_idx]
-                        )
-
-                    # Set predicted labels from classifier
-                    if clf_factuality is not None:
-                        summary_entities = clf_factuality.classify_entities(
-                            summary_entities,
-                            gen_summaries_by_id,
-                            {k: v for k, v in batch_sources},
-                        )
-
-                    # Set labels from oracle
-                    oracle_labeled_entities = oracle_label_entities(
-                        summary_entities,
-                        get_entity_annotations(
-                            summary_entities.keys(), summary_gold_metadata
-                        ),
-                        args.entity_label_match,
+                    num_tokens = generation_metadata[id_to_idx[sum_id]].get(
+                        "num_tokens"
                     )
+                    if summary != SUMMARY_FAILED_GENERATION and num_tokens is not None:
+                        num_tokens_by_sum_id[sum_id] = num_tokens
 
                 # Update results based on oracle labels & banned words based on predictions
                 for sum_id, labeled_entities in oracle_labeled_entities.items():
@@ -404,6 +700,23 @@ if __name__ == "__main__":
 
             iter_total = len(docs_to_summarize)
             print_results("Iteration Summary Stats", results_by_sum_id)
+            pipeline.print_utilisation()
+            if generation_cache is not None:
+                print(
+                    f"Generation cache hit rate: {generation_cache.hit_rate():.2%}"
+                )
+            if feature_store is not None:
+                print(f"Feature store hit rate: {feature_store.hit_rate():.2%}")
+            if ner_cache is not None:
+                print(f"NER cache hit rate: {ner_cache.hit_rate():.2%}")
+            if (
+                clf_factuality is not None
+                and clf_factuality.cascade_threshold is not None
+            ):
+                print(
+                    "Posterior calls avoided: "
+                    + f"{clf_factuality.posterior_calls_avoided_rate():.2%}"
+                )
 
             # break if no new constriants
             if new_constraints == 0:
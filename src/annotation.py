@@ -1,13 +1,13 @@
 from collections import defaultdict
 from typing import Dict
-from sumtool.storage import store_summary_metrics
 
 from src.data_utils import XSumDoc
-from src.entity_factuality import ANNOTATION_LABELS
-from src.entity_utils import MarkedEntityLookup
+from src.entity_utils import ANNOTATION_LABELS, MarkedEntityLookup
 
 
 def persist_updated_annotations(old_metadata, updated_annotations, summaries_by_id):
+    from sumtool.storage import store_summary_metrics
+
     updated_metadata = old_metadata.copy()
     for sum_id, new_annotations in updated_annotations.items():
         if sum_id in old_metadata:
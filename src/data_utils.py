@@ -1,9 +1,9 @@
 from typing import Dict, List, Literal, Tuple, TypedDict, Union
 import json
-from datasets.load import load_dataset
-from sumtool.storage import get_summary_metrics, get_summaries
+import os
 
-from src.generation_utils import SUMMARY_FAILED_GENERATION
+
+SUMMARY_FAILED_GENERATION = "<Failed generation: blocked all beams>"
 
 
 class XSumDoc(TypedDict):
@@ -20,6 +20,8 @@ class XEntExample(TypedDict):
 
 
 def load_xsum_dict(split) -> Dict[str, XSumDoc]:
+    from datasets.load import load_dataset
+
     return {x["id"]: x for x in load_dataset("xsum")[split]}
 
 
@@ -30,23 +32,110 @@ def load_xent(split: str) -> List[XEntExample]:
         return json.load(f)
 
 
-def persist_example_with_probs(
-    output_filepath: str,
-    output_dataset: List[dict],
-    output_dataset_idx: int,
+def add_probs_to_example(
     example: XEntExample,
     entity_texts: List[str],
     entity_probs: List[Tuple[float]],
-):
+) -> XEntExample:
     xent_example_with_probs = example.copy()
     entity_probs_with_names = dict(zip(entity_texts, entity_probs))
 
     for entity in xent_example_with_probs["entities"]:
-        prior, posterior = entity_probs_with_names[entity["ent"]]
+        prior, posterior = entity_probs_with_names[entity["ent"]][:2]
         entity["prior_prob"] = prior
         entity["posterior_prob"] = posterior
+        if len(entity_probs_with_names[entity["ent"]]) == 4:
+            prior_log, posterior_log = entity_probs_with_names[entity["ent"]][2:]
+            entity["prior_log_prob"] = prior_log
+            entity["posterior_log_prob"] = posterior_log
+    return xent_example_with_probs
 
-    output_dataset[output_dataset_idx] = xent_example_with_probs
+
+def persist_example_with_probs(
+    output_filepath: str,
+    output_dataset: List[dict],
+    output_dataset_idx: int,
+    example: XEntExample,
+    entity_texts: List[str],
+    entity_probs: List[Tuple[float]],
+):
+    output_dataset[output_dataset_idx] = add_probs_to_example(
+        example, entity_texts, entity_probs
+    )
+    with open(output_filepath, "w") as f:
+        json.dump(output_dataset, f, indent=2)
+
+
+class JsonlAppendWriter:
+    """
+    Appends one {"idx", "example"} JSON line per processed example, so that
+    writing is linear in the number of examples and a crashed run can be
+    resumed. Lines are flushed right away & fsynced every `fsync_every`
+    examples.
+    """
+
+    def __init__(self, filepath: str, resume: bool = False, fsync_every: int = 50):
+        self.filepath = filepath
+        self.fsync_every = fsync_every
+        self.done = read_jsonl_examples(filepath) if resume else {}
+        if resume and os.path.exists(filepath):
+            # rewrite without a possibly truncated last line
+            self._rewrite(self.done)
+        self.f = open(filepath, "a" if resume else "w")
+        self.n_unsynced = 0
+
+    def _rewrite(self, examples_by_idx: Dict[int, dict]):
+        tmp_path = self.filepath + ".tmp"
+        with open(tmp_path, "w") as f:
+            for idx, example in examples_by_idx.items():
+                f.write(json.dumps({"idx": idx, "example": example}) + "\n")
+        os.replace(tmp_path, self.filepath)
+
+    def write(self, idx: int, example: dict):
+        self.f.write(json.dumps({"idx": idx, "example": example}) + "\n")
+        self.f.flush()
+        self.done[idx] = example
+        self.n_unsynced += 1
+        if self.n_unsynced >= self.fsync_every:
+            self.sync()
+
+    def sync(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.n_unsynced = 0
+
+    def close(self):
+        self.sync()
+        self.f.close()
+
+
+def read_jsonl_examples(filepath: str) -> Dict[int, dict]:
+    examples_by_idx = {}
+    if not os.path.exists(filepath):
+        return examples_by_idx
+    with open(filepath, "r") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # last line of a crashed run
+                break
+            examples_by_idx[entry["idx"]] = entry["example"]
+    return examples_by_idx
+
+
+def compact_jsonl_examples(
+    jsonl_filepaths: List[str], output_filepath: str, input_dataset: List[dict]
+):
+    """
+    Writes the input dataset with every example from the JSONL files
+    (e.g. one per shard) in its place, in the same JSON layout as
+    `persist_example_with_probs`.
+    """
+    output_dataset = list(input_dataset)
+    for jsonl_filepath in jsonl_filepaths:
+        for idx, example in read_jsonl_examples(jsonl_filepath).items():
+            output_dataset[idx] = example
     with open(output_filepath, "w") as f:
         json.dump(output_dataset, f, indent=2)
 
@@ -95,7 +184,28 @@ def split_batches(lst, size):
         yield lst[i : i + size]
 
 
+def pack_batches_by_length(lengths: List[int], max_tokens: int) -> List[List[int]]:
+    """
+    Batches of indices, sorted by length (longest first), such that every
+    padded batch (batch size * longest length) stays under `max_tokens`.
+    Items longer than `max_tokens` get a batch of their own.
+    """
+    sorted_idxs = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    batches: List[List[int]] = []
+    for idx in sorted_idxs:
+        if len(batches) > 0:
+            # the first item of a batch is its longest one
+            padded_length = lengths[batches[-1][0]]
+            if (len(batches[-1]) + 1) * padded_length <= max_tokens:
+                batches[-1].append(idx)
+                continue
+        batches.append([idx])
+    return batches
+
+
 def load_summaries_from_logs(path, max_iterations=5):
+    from sumtool.storage import get_summaries
+
     with open(path, "r") as f:
         logs = json.load(f)
 
@@ -125,4 +235,6 @@ def load_summaries_from_logs(path, max_iterations=5):
 
 
 def get_gold_xsum_data():
+    from sumtool.storage import get_summaries, get_summary_metrics
+
     return (get_summaries("xsum", "gold"), get_summary_metrics("xsum", "gold"))
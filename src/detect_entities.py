@@ -1,12 +1,86 @@
-from typing import List
-import spacy
-from spacy.tokens import Span
-from src.entity_utils import MarkedEntity, is_entity_contained
+from typing import TYPE_CHECKING, List, Optional, Tuple
+from src.entity_utils import MarkedEntity, mark_in_source
+from src.ner_cache import EntitySpan, NERCache
 
-nlp = spacy.load("en_core_web_lg")
+# spaCy is imported on first use, importing it takes seconds
+if TYPE_CHECKING:
+    from spacy.language import Language
+    from spacy.tokens import Doc, Span
 
+SPACY_MODELS = {
+    "sm": "en_core_web_sm",
+    "md": "en_core_web_md",
+    "lg": "en_core_web_lg",
+}
 
-def split_person_entity(entity: Span, source: str) -> List[MarkedEntity]:
+# Only `doc.ents` & token `ent_type_` are used, which the NER sets by itself
+UNUSED_COMPONENTS = ["tagger", "parser", "attribute_ruler", "lemmatizer", "senter"]
+
+spacy_tier = "lg"
+lean_pipeline = True
+_nlp = None
+ner_cache: Optional[NERCache] = None
+
+
+def load_nlp(tier: str = "lg", lean: bool = True) -> "Language":
+    """
+    Loads the spaCy pipeline of a model tier (sm|md|lg). A lean pipeline
+    excludes every component that entity recognition doesn't need.
+    """
+    import spacy
+
+    if tier not in SPACY_MODELS:
+        raise ValueError(f"Unknown spaCy tier {tier}, expected one of sm|md|lg")
+    if not lean:
+        return spacy.load(SPACY_MODELS[tier])
+
+    nlp = spacy.load(SPACY_MODELS[tier], exclude=UNUSED_COMPONENTS)
+    # The NER of the en_core_web models has its own embedding layer, the shared
+    # tok2vec is only needed if a remaining component listens to it
+    if "tok2vec" in nlp.pipe_names and not nlp.get_pipe("tok2vec").listening_components:
+        nlp.remove_pipe("tok2vec")
+    return nlp
+
+
+def configure_nlp(tier: str = "lg", lean: bool = True):
+    """
+    Selects the spaCy pipeline used by `detect_entities`, before its first use.
+    """
+    global spacy_tier, lean_pipeline, _nlp
+    if (tier, lean) != (spacy_tier, lean_pipeline):
+        spacy_tier, lean_pipeline, _nlp = tier, lean, None
+
+
+def configure_ner_cache(db_path: Optional[str]) -> Optional[NERCache]:
+    """
+    Caches detected entity spans by summary text in a SQLite database
+    (or disables the cache if `db_path` is empty).
+    """
+    global ner_cache
+    ner_cache = NERCache(db_path) if db_path else None
+    return ner_cache
+
+
+def nlp_model_id() -> str:
+    """
+    Name & version of the configured spaCy model & whether its pipeline is
+    lean, without loading it.
+    """
+    import spacy
+
+    model_name = SPACY_MODELS[spacy_tier]
+    model_id = f"{model_name}-{spacy.util.get_package_version(model_name)}"
+    return f"{model_id}-lean" if lean_pipeline else model_id
+
+
+def get_nlp() -> "Language":
+    global _nlp
+    if _nlp is None:
+        _nlp = load_nlp(spacy_tier, lean_pipeline)
+    return _nlp
+
+
+def split_person_parts(entity: "Span") -> List[MarkedEntity]:
     split_entity: List[MarkedEntity] = []
     ent_parts: List[str] = entity.text.split(" ")
     start_idx = entity[0].idx
@@ -17,17 +91,21 @@ def split_person_entity(entity: Span, source: str) -> List[MarkedEntity]:
                 "type": "PERSON",
                 "start": start_idx,
                 "end": start_idx + len(sub_ent),
-                "in_source": is_entity_contained(sub_ent, source),
+                "in_source": False,
             }
         )
         start_idx += len(sub_ent) + 1
     return split_entity
 
 
-def detect_entities(summary: str, source: str) -> List[MarkedEntity]:
-    nlp_summary = nlp(summary)
+def split_person_entity(entity: "Span", source: str) -> List[MarkedEntity]:
+    split_entity = split_person_parts(entity)
+    mark_in_source(split_entity, source)
+    return split_entity
 
-    marked_entities: List[MarkedEntity] = []
+
+def entity_spans_from_doc(nlp_summary: "Doc") -> List[EntitySpan]:
+    entity_spans: List[EntitySpan] = []
     for entity in nlp_summary.ents:
         # split person entities
         if (
@@ -35,16 +113,74 @@ def detect_entities(summary: str, source: str) -> List[MarkedEntity]:
             and len(entity) > 1
             and entity[0].text != "St"
         ):
-            marked_entities += split_person_entity(entity, source)
+            entity_spans += [
+                (x["ent"], x["type"], x["start"], x["end"])
+                for x in split_person_parts(entity)
+            ]
         else:
-            marked_entities.append(
-                {
-                    "ent": entity.text,
-                    "type": entity[0].ent_type_,
-                    "start": entity.start_char,
-                    "end": entity.end_char,
-                    "in_source": is_entity_contained(entity.text, source),
-                }
+            entity_spans.append(
+                (entity.text, entity[0].ent_type_, entity.start_char, entity.end_char)
             )
+    return entity_spans
+
 
+def marked_entities_from_spans(
+    entity_spans: List[EntitySpan], source: str
+) -> List[MarkedEntity]:
+    marked_entities: List[MarkedEntity] = [
+        {"ent": ent, "type": ent_type, "start": start, "end": end, "in_source": False}
+        for ent, ent_type, start, end in entity_spans
+    ]
+    # the source is casefolded once for all of the summary's entities
+    mark_in_source(marked_entities, source)
     return marked_entities
+
+
+def marked_entities_from_doc(nlp_summary: "Doc", source: str) -> List[MarkedEntity]:
+    return marked_entities_from_spans(entity_spans_from_doc(nlp_summary), source)
+
+
+def detect_entities(summary: str, source: str) -> List[MarkedEntity]:
+    return detect_entities_batch([(summary, source)])[0]
+
+
+def detect_entities_batch(
+    pairs: List[Tuple[str, str]], batch_size: int = 64, n_process: int = 1
+) -> List[List[MarkedEntity]]:
+    """
+    Detects the entities of (summary, source) pairs with `nlp.pipe`,
+    in batches of `batch_size` summaries over `n_process` processes.
+    Each unique summary is only run through spaCy once, and not at all
+    if its entity spans are in the configured NER cache.
+    Returns the marked entities of every pair, in input order.
+    """
+    summaries = list(dict.fromkeys(summary for summary, _ in pairs))
+    if ner_cache is not None:
+        model_id = nlp_model_id()
+        keys = {summary: NERCache.key(model_id, summary) for summary in summaries}
+        cached = ner_cache.get_many(list(keys.values()))
+        spans_by_summary = {
+            summary: cached[key] for summary, key in keys.items() if key in cached
+        }
+    else:
+        spans_by_summary = {}
+
+    missing_summaries = [x for x in summaries if x not in spans_by_summary]
+    if len(missing_summaries) > 0:
+        docs = get_nlp().pipe(
+            missing_summaries, batch_size=batch_size, n_process=n_process
+        )
+        new_spans = {
+            summary: entity_spans_from_doc(doc)
+            for summary, doc in zip(missing_summaries, docs)
+        }
+        spans_by_summary.update(new_spans)
+        if ner_cache is not None:
+            ner_cache.put_many(
+                {keys[summary]: spans for summary, spans in new_spans.items()}
+            )
+
+    return [
+        marked_entities_from_spans(spans_by_summary[summary], source)
+        for summary, source in pairs
+    ]
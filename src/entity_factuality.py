@@ -1,29 +1,95 @@
-from compute_probs import compute_probs_for_summary
-from src.entity_utils import MarkedEntityLookup
-from sklearn.neighbors import KNeighborsClassifier
+from typing import TYPE_CHECKING, Any, List, Optional
+from src.data_utils import split_batches
+from src.entity_utils import ANNOTATION_LABELS, MarkedEntityLookup
 import numpy as np
+from src.knn_engine import CompiledKNNClassifier
 from src.misc_utils import Timer
+import os
 import pickle
-from src.generation_utils import (
-    load_posterior_model_and_tokenizer,
-    load_prior_model_and_tokenizer,
-)
 from src.prob_computation_utils import (
     InferenceInput,
     build_masked_inputs_and_targets_for_inference,
 )
+from src.feature_store import ProbFeatureStore
+from src.token_cache import TokenizationCache
 import pandas as pd
 
+# torch, transformers & the compute_probs script are imported on first use,
+# so that importing this module (e.g. for the labels) stays cheap
+if TYPE_CHECKING:
+    from sklearn.neighbors import KNeighborsClassifier as PickledClassifier
+else:
+    PickledClassifier = Any
+
+FEATURE_COLUMNS = ["prior_prob", "posterior_prob", "overlaps_source"]
 
-ANNOTATION_LABELS = {
-    "Non-factual": "Non-factual Hallucination",
-    "Factual": "Factual Hallucination",
-    "Non-hallucinated": "Non-hallucinated",
-    "Unknown": "Unknown",
-    "Intrinsic": "Intrinsic Hallucination",
-}
+# Posterior probs at which the kNN vote is checked when the posterior is unknown,
+# log-spaced since most posteriors of hallucinated entities are ~1e-5 to 1e-2
+POSTERIOR_GRID = np.unique(
+    np.concatenate([[0.0], np.logspace(-8, 0, 33), np.linspace(0, 1, 11)])
+)
 
-PickledClassifier = KNeighborsClassifier
+
+def training_posterior_range(clf: PickledClassifier) -> Optional[np.ndarray]:
+    """
+    Min & max posterior prob of the training points of a kNN classifier
+    (a `CompiledKNNClassifier` or a `Pipeline(StandardScaler, KNeighborsClassifier)`).
+    """
+    if isinstance(clf, CompiledKNNClassifier):
+        train_X, mean, scale = clf.train_X, clf.mean, clf.scale
+        feature_names = clf.feature_names
+    elif hasattr(clf, "steps") and hasattr(clf[-1], "_fit_X"):
+        train_X, feature_names = clf[-1]._fit_X, getattr(clf, "feature_names_in_", None)
+        mean, scale = clf[0].mean_, clf[0].scale_
+    else:
+        return None
+    col = 1
+    if feature_names is not None:
+        col = list(feature_names).index("posterior_prob")
+    posteriors = np.asarray(train_X[:, col]) * scale[col] + mean[col]
+    return np.array([posteriors.min(), posteriors.max()])
+
+
+def posterior_grid(clf: PickledClassifier) -> np.ndarray:
+    """
+    `POSTERIOR_GRID` extended with the extremes of the classifier's
+    training posteriors.
+    """
+    posterior_range = training_posterior_range(clf)
+    if posterior_range is None:
+        return POSTERIOR_GRID
+    return np.unique(np.concatenate([POSTERIOR_GRID, posterior_range]))
+
+
+def prior_only_predictions(
+    clf: PickledClassifier,
+    features: pd.DataFrame,
+    threshold: float,
+    grid: np.ndarray = POSTERIOR_GRID,
+) -> np.ndarray:
+    """
+    Predicts labels from the prior prob & source overlap alone, for the
+    entities whose kNN neighbourhood vote (`predict_proba`) gives the same
+    label with at least `threshold` of the votes for any posterior prob on
+    the `grid` (see `posterior_grid`). Returns -1 for entities that still
+    need the posterior.
+    """
+    n_entities, n_grid = len(features), len(grid)
+    grid_features = pd.DataFrame(
+        {
+            "prior_prob": np.repeat(features["prior_prob"].to_numpy(), n_grid),
+            "posterior_prob": np.tile(grid, n_entities),
+            "overlaps_source": np.repeat(
+                features["overlaps_source"].to_numpy(), n_grid
+            ),
+        }
+    )[FEATURE_COLUMNS]
+    probas = clf.predict_proba(grid_features).reshape(n_entities, n_grid, -1)
+    grid_labels = probas.argmax(axis=-1)
+    is_certain = (probas.max(axis=-1) >= threshold).all(axis=1) & (
+        grid_labels == grid_labels[:, :1]
+    ).all(axis=1)
+    return np.where(is_certain, clf.classes_[grid_labels[:, 0]], -1)
 
 
 class EntityFactualityClassifier:
@@ -35,29 +101,97 @@ class EntityFactualityClassifier:
     """
 
     def __init__(
-        self, pickled_model_path, prior_model_path, posterior_model_path, batch_size=4
+        self,
+        pickled_model_path,
+        prior_model_path,
+        posterior_model_path,
+        batch_size=4,
+        token_cache: Optional[TokenizationCache] = None,
+        feature_store: Optional[ProbFeatureStore] = None,
+        cascade_threshold: Optional[float] = None,
     ):
+        self.token_cache = token_cache
+        self.feature_store = feature_store
+        self.cascade_threshold = cascade_threshold
+        self.prior_model_path = prior_model_path
+        self.posterior_model_path = posterior_model_path
+        self._prior_model_and_tokenizer = None
+        self._posterior_model_and_tokenizer = None
+        self.n_posterior_calls = 0
+        self.n_posterior_calls_avoided = 0
+        self.n_feature_store_hits = 0
         with Timer("Initializing entity factuality classifier"):
-            with open(pickled_model_path, "rb") as f:
-                self.clf: PickledClassifier = pickle.load(f)
             self.label_mapping = {
                 0: ANNOTATION_LABELS["Factual"],
                 1: ANNOTATION_LABELS["Non-factual"],
             }
+            if os.path.isdir(pickled_model_path):
+                # exported by train_factuality_clf.py --artifact_dir
+                self.clf, manifest = CompiledKNNClassifier.load_artifact(
+                    pickled_model_path
+                )
+                self.label_mapping = {
+                    int(k): v for k, v in manifest["label_mapping"].items()
+                }
+            elif pickled_model_path.endswith(".npz"):
+                # exported by train_factuality_clf.py --compiled_clf_path
+                self.clf = CompiledKNNClassifier.load(pickled_model_path)
+            else:
+                with open(pickled_model_path, "rb") as f:
+                    self.clf: PickledClassifier = pickle.load(f)
             self.batch_size = batch_size
-            self.prior_model_and_tokenizer = load_prior_model_and_tokenizer(
-                prior_model_path
-            )
-            self.posterior_model_and_tokenizer = load_posterior_model_and_tokenizer(
-                posterior_model_path
-            )
-
-    def extract_features(self, ents_to_classify: InferenceInput):
+            self.posterior_grid = posterior_grid(self.clf)
+
+    @property
+    def prior_model_and_tokenizer(self):
+        # Loaded on first use, runs without extrinsic entities never need it
+        if self._prior_model_and_tokenizer is None:
+            from src.generation_utils import load_prior_model_and_tokenizer
+
+            with Timer("Loading prior model"):
+                self._prior_model_and_tokenizer = load_prior_model_and_tokenizer(
+                    self.prior_model_path
+                )
+        return self._prior_model_and_tokenizer
+
+    @property
+    def posterior_model_and_tokenizer(self):
+        if self._posterior_model_and_tokenizer is None:
+            from src.generation_utils import load_posterior_model_and_tokenizer
+
+            with Timer("Loading posterior model"):
+                self._posterior_model_and_tokenizer = (
+                    load_posterior_model_and_tokenizer(self.posterior_model_path)
+                )
+        return self._posterior_model_and_tokenizer
+
+    def posterior_calls_avoided_rate(self) -> float:
+        """
+        Fraction of the classified entities whose posterior wasn't computed
+        thanks to the cascade (feature store hits are counted separately).
+        """
+        total = (
+            self.n_posterior_calls
+            + self.n_posterior_calls_avoided
+            + self.n_feature_store_hits
+        )
+        return self.n_posterior_calls_avoided / total if total > 0 else 0.0
+
+    def extract_features(
+        self,
+        ents_to_classify: InferenceInput,
+        source_ids: Optional[List[List[int]]] = None,
+    ):
+        from compute_probs import compute_probs_for_summary
+
         features = []
-        for (_, _, ents) in ents_to_classify:
+        entity_source_ids = [] if source_ids is not None else None
+        for input_idx, (_, _, ents) in enumerate(ents_to_classify):
             for ent in ents:
                 # prior / posterior / in_source
                 features.append([0, 0, 1.0 if ent["in_source"] else 0.0])
+                if source_ids is not None:
+                    entity_source_ids.append(source_ids[input_idx])
         features = np.array(features)
         (
             inputs,
@@ -74,16 +208,109 @@ class EntityFactualityClassifier:
             batch_size=self.batch_size,
             prior_model_and_tokenizer=self.prior_model_and_tokenizer,
             posterior_model_and_tokenizer=self.posterior_model_and_tokenizer,
+            source_ids=entity_source_ids,
+            feature_store=self.feature_store,
         )
 
         for i, (prior, posterior) in enumerate(entity_probs):
             features[i][0] = prior
             features[i][1] = posterior
 
-        return pd.DataFrame(
-            features, columns=["prior_prob", "posterior_prob", "overlaps_source"]
+        return pd.DataFrame(features, columns=FEATURE_COLUMNS)
+
+    def _source_ids(self, sum_ids: List[str], sources: List[str]):
+        if self.token_cache is None:
+            return None
+        return self.token_cache.get_or_tokenize(
+            self.posterior_model_and_tokenizer[1], sum_ids, sources
+        )
+
+    def classify_cascaded(
+        self, ents_to_classify: InferenceInput, sum_ids: List[str]
+    ) -> np.ndarray:
+        """
+        Computes the (cheaper) prior first and only computes the posterior
+        for the entities whose kNN vote is uncertain without it.
+        """
+        import torch
+        from compute_probs import (
+            compute_posterior_probs_for_batch,
+            compute_prior_probs_for_batch,
         )
 
+        (
+            inputs,
+            targets,
+            masked_entities,
+            sources,
+        ) = build_masked_inputs_and_targets_for_inference(ents_to_classify)
+        entity_sum_ids = [
+            sum_id
+            for sum_id, (_, _, ents) in zip(sum_ids, ents_to_classify)
+            for _ in ents
+        ]
+        features = pd.DataFrame(
+            {
+                "prior_prob": 0.0,
+                "posterior_prob": np.nan,
+                "overlaps_source": [
+                    1.0 if ent["in_source"] else 0.0
+                    for (_, _, ents) in ents_to_classify
+                    for ent in ents
+                ],
+            }
+        )
+
+        prior_model, _ = self.prior_model_and_tokenizer
+        with torch.no_grad():
+            for batch_idxs in split_batches(list(range(len(inputs))), self.batch_size):
+                batch_prior_probs, _ = compute_prior_probs_for_batch(
+                    [inputs[i] for i in batch_idxs],
+                    [targets[i] for i in batch_idxs],
+                    [masked_entities[i] for i in batch_idxs],
+                    self.prior_model_and_tokenizer,
+                    prior_model.device,
+                )
+                features.loc[batch_idxs, "prior_prob"] = batch_prior_probs
+
+        predictions = prior_only_predictions(
+            self.clf, features, self.cascade_threshold, self.posterior_grid
+        )
+        uncertain_idxs = np.flatnonzero(predictions == -1).tolist()
+        self.n_posterior_calls += len(uncertain_idxs)
+        self.n_posterior_calls_avoided += len(inputs) - len(uncertain_idxs)
+        if len(uncertain_idxs) == 0:
+            return predictions
+
+        source_ids = self._source_ids(
+            [entity_sum_ids[i] for i in uncertain_idxs],
+            [sources[i] for i in uncertain_idxs],
+        )
+        posterior_model, _ = self.posterior_model_and_tokenizer
+        with torch.no_grad():
+            for batch_start in range(0, len(uncertain_idxs), self.batch_size):
+                batch_idxs = uncertain_idxs[batch_start : batch_start + self.batch_size]
+                batch_posterior_probs, _ = compute_posterior_probs_for_batch(
+                    [inputs[i] for i in batch_idxs],
+                    [targets[i] for i in batch_idxs],
+                    [masked_entities[i] for i in batch_idxs],
+                    [sources[i] for i in batch_idxs],
+                    (
+                        source_ids[batch_start : batch_start + self.batch_size]
+                        if source_ids is not None
+                        else None
+                    ),
+                    self.posterior_model_and_tokenizer,
+                    self.prior_model_and_tokenizer[1],
+                    posterior_model.device,
+                )
+                features.loc[batch_idxs, "posterior_prob"] = batch_posterior_probs
+
+        predictions[uncertain_idxs] = self.clf.predict(
+            features.iloc[uncertain_idxs][FEATURE_COLUMNS]
+        )
+        return predictions
+
     def classify_entities(
         self,
         marked_entities: MarkedEntityLookup,
@@ -94,6 +321,7 @@ class EntityFactualityClassifier:
         # Build a list of (sum, source, ents[]) to enable
         # batching across summaries when extracting feaatures
         ents_to_classify: InferenceInput = []
+        ents_to_classify_sum_ids = []
         for sum_id, summary in gen_summaries_by_id.items():
             updated_entities = [x.copy() for x in marked_entities[sum_id]]
             for ent in updated_entities:
@@ -111,11 +339,30 @@ class EntityFactualityClassifier:
                         ents_not_in_source,
                     )
                 )
+                ents_to_classify_sum_ids.append(sum_id)
             classified_entities[sum_id] = updated_entities
 
         if len(ents_to_classify) > 0:
-            features = self.extract_features(ents_to_classify)
-            predictions = self.clf.predict(features)
+            if self.cascade_threshold is not None:
+                predictions = self.classify_cascaded(
+                    ents_to_classify, ents_to_classify_sum_ids
+                )
+            else:
+                source_ids = self._source_ids(
+                    ents_to_classify_sum_ids,
+                    [source for (_, source, _) in ents_to_classify],
+                )
+                misses_before = (
+                    self.feature_store.misses if self.feature_store is not None else 0
+                )
+                features = self.extract_features(ents_to_classify, source_ids)
+                predictions = self.clf.predict(features)
+                if self.feature_store is not None:
+                    n_computed = self.feature_store.misses - misses_before
+                else:
+                    n_computed = len(features)
+                self.n_posterior_calls += n_computed
+                self.n_feature_store_hits += len(features) - n_computed
             idx = 0
             for (_, _, ents) in ents_to_classify:
                 for entity in ents:
@@ -123,3 +370,64 @@ class EntityFactualityClassifier:
                     idx += 1
 
         return classified_entities
+
+
+class EntityClassificationQueue:
+    """
+    Collects the detected entities of several generation batches and
+    classifies them together once `target_n_entities` extrinsic entities
+    are queued, so that the prior & posterior models see full batches
+    regardless of the generation batch size.
+
+    Batches are dicts with "summary_entities", "gen_summaries_by_id" &
+    "sources_by_id" (see `iterative_constraints.py`); classified entities
+    are assigned back to their batch by summary id.
+    """
+
+    def __init__(
+        self, clf_factuality: EntityFactualityClassifier, target_n_entities: int
+    ):
+        self.clf_factuality = clf_factuality
+        self.target_n_entities = target_n_entities
+        self.pending_batches = []
+        self.n_pending_entities = 0
+
+    def push(self, batch) -> List[dict]:
+        """
+        Queues a batch, returns the classified batches if the queue was flushed.
+        """
+        self.pending_batches.append(batch)
+        self.n_pending_entities += sum(
+            1
+            for ents in batch["summary_entities"].values()
+            for ent in ents
+            if not ent["in_source"]
+        )
+        if self.n_pending_entities >= self.target_n_entities:
+            return self.flush()
+        return []
+
+    def flush(self) -> List[dict]:
+        """
+        Classifies all queued entities, returns the batches in queue order.
+        """
+        batches = self.pending_batches
+        self.pending_batches = []
+        self.n_pending_entities = 0
+        if len(batches) == 0:
+            return batches
+
+        summary_entities, gen_summaries_by_id, sources_by_id = {}, {}, {}
+        for batch in batches:
+            summary_entities.update(batch["summary_entities"])
+            gen_summaries_by_id.update(batch["gen_summaries_by_id"])
+            sources_by_id.update(batch["sources_by_id"])
+        classified_entities = self.clf_factuality.classify_entities(
+            summary_entities, gen_summaries_by_id, sources_by_id
+        )
+        for batch in batches:
+            batch["summary_entities"] = {
+                sum_id: classified_entities[sum_id]
+                for sum_id in batch["summary_entities"].keys()
+            }
+        return batches
@@ -1,10 +1,10 @@
 from collections import defaultdict
 from typing import DefaultDict, List, Optional, TypedDict
 from src.annotation import prompt_annotation_flow
-from src.detect_entities import detect_entities
+from src.detect_entities import detect_entities_batch
 from src.entity_utils import MarkedEntity, count_entities, filter_entities
 from src.oracle import EntityMatchType, get_entity_annotations, oracle_label_entities
-from src.entity_factuality import ANNOTATION_LABELS
+from src.entity_utils import ANNOTATION_LABELS
 from src.metrics import rouge
 import numpy as np
 from tqdm import tqdm
@@ -21,11 +21,16 @@ def get_labeled_entities(
     force_annotation_flow=False
 ):
     # Detect entities if they're not cached
-    for sum_id, summary in sums_by_id.items():
-        if sum_id not in sum_ents_by_id:
-            sum_ents_by_id[sum_id] = detect_entities(
-                summary, xsum_test[sum_id]["document"]
-            )
+    missing_ids = [
+        sum_id for sum_id in sums_by_id.keys() if sum_id not in sum_ents_by_id
+    ]
+    detected_entities = detect_entities_batch(
+        [
+            (sums_by_id[sum_id], xsum_test[sum_id]["document"])
+            for sum_id in missing_ids
+        ]
+    )
+    sum_ents_by_id.update(zip(missing_ids, detected_entities))
     labeled_ents = oracle_label_entities(
         sum_ents_by_id,
         get_entity_annotations(sum_ents_by_id.keys(), gold_metadata),
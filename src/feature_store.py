@@ -0,0 +1,86 @@
+from typing import Dict, List, Optional, Tuple
+import hashlib
+import json
+from src.sqlite_store import SQLiteKeyValueStore
+
+
+class ProbFeatureStore(SQLiteKeyValueStore):
+    """
+    Disk-backed (SQLite) store of prior & posterior entity probabilities.
+
+    Entries are keyed by a hash of the prior model id, posterior model id,
+    masked input, target summary, source hash & scoring settings, and
+    hold the prior/posterior probabilities & log-probabilities. Repeated
+    runs and GEF iterations then only score new (summary, entity) pairs.
+
+    Args:
+        db_path (`str`):
+            Path of the SQLite database file.
+    """
+
+    def __init__(self, db_path: str):
+        super().__init__(
+            db_path,
+            "entity_probs",
+            [
+                "prior_prob REAL",
+                "posterior_prob REAL",
+                "prior_log_prob REAL",
+                "posterior_log_prob REAL",
+            ],
+        )
+
+    @staticmethod
+    def key(
+        prior_model_id: str,
+        posterior_model_id: str,
+        masked_input: str,
+        target: str,
+        source_hash: str,
+        scoring: str,
+        prior_mode: str,
+    ) -> str:
+        return hashlib.sha256(
+            json.dumps(
+                [
+                    prior_model_id,
+                    posterior_model_id,
+                    masked_input,
+                    target,
+                    source_hash,
+                    scoring,
+                    prior_mode,
+                ]
+            ).encode("utf-8")
+        ).hexdigest()
+
+    def get_many(self, keys: List[str]) -> Dict[str, Tuple[float, ...]]:
+        """
+        Returns (prior, posterior, prior log, posterior log) for the keys
+        that are in the store.
+        """
+        return super().get_many(keys)
+
+
+def lookup_or_compute(
+    feature_store: Optional[ProbFeatureStore],
+    keys: List[str],
+    compute_fn,
+) -> List[Tuple[float, ...]]:
+    """
+    Returns the stored values for every key, calling `compute_fn` with
+    the indices of the missing keys and storing its results.
+    """
+    if feature_store is None:
+        return compute_fn(list(range(len(keys))))
+
+    found = feature_store.get_many(keys)
+    missing_idxs = [idx for idx, key in enumerate(keys) if key not in found]
+    if len(missing_idxs) > 0:
+        computed = compute_fn(missing_idxs)
+        new_entries = {
+            keys[idx]: tuple(values) for idx, values in zip(missing_idxs, computed)
+        }
+        feature_store.put_many(new_entries)
+        found.update(new_entries)
+    return [found[key] for key in keys]
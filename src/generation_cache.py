@@ -0,0 +1,222 @@
+from collections import OrderedDict
+from typing import Dict, List, Optional
+import hashlib
+import json
+import os
+from transformers.tokenization_utils_base import BatchEncoding
+from src.beam_validators import BannedPhrases
+from src.generation_utils import generate_summaries, select_inputs
+from src.misc_utils import model_id as get_model_id
+from src.word_logits_processor import WordLogitsProcessor
+
+
+class GenerationCache:
+    """
+    Content-addressed on-disk cache of generated summaries.
+
+    Entries are keyed by a hash of the per-example inputs that determine
+    the output of constrained beam search (model, document, beam settings,
+    banned phrases & length budget) and hold the summary with compact
+    generation metadata. Once the cache grows beyond `max_size_mb`, the
+    least recently used entries are evicted down to `low_water_mark` of
+    the cap, so that eviction runs once per batch of inserts.
+
+    Sizes & recency of the entries are kept in an in-memory LRU index,
+    loaded from the directory once when the cache is opened.
+
+    Args:
+        cache_dir (`str`):
+            Directory to store the cache entries in.
+        max_size_mb (`float`):
+            Size cap of the cache.
+        low_water_mark (`float`):
+            Fraction of the size cap that eviction brings the cache down to.
+    """
+
+    def __init__(
+        self, cache_dir: str, max_size_mb: float = 1024, low_water_mark: float = 0.9
+    ):
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_mb * 1024 * 1024
+        self.low_water_mark = low_water_mark
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        # entry path -> size in bytes, least recently used first
+        self._index: "OrderedDict[str, int]" = OrderedDict()
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for fname in files:
+                if fname.endswith(".json"):
+                    path = os.path.join(root, fname)
+                    stat = os.stat(path)
+                    entries.append((stat.st_mtime, path, stat.st_size))
+        for _, path, size in sorted(entries):
+            self._index[path] = size
+        self.size_bytes = sum(self._index.values())
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    @staticmethod
+    def key(
+        model_id: str,
+        document: str,
+        num_beams: int,
+        banned_phrases,
+        max_length: Optional[int] = None,
+    ) -> str:
+        return hashlib.sha256(
+            json.dumps(
+                {
+                    "model": model_id,
+                    "document": document,
+                    "num_beams": num_beams,
+                    "banned_phrases": sorted(banned_phrases),
+                    "max_length": max_length,
+                },
+                sort_keys=True,
+            ).encode("utf-8")
+        ).hexdigest()
+
+    def get(self, key: str) -> Optional[dict]:
+        path = self._entry_path(key)
+        try:
+            with open(path, "r") as f:
+                entry = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.misses += 1
+            return None
+        # mark as recently used, on disk too for the next time the cache is opened
+        os.utime(path)
+        if path in self._index:
+            self._index.move_to_end(path)
+        else:
+            # written by another process since the index was loaded
+            self._index[path] = os.path.getsize(path)
+            self.size_bytes += self._index[path]
+        self.hits += 1
+        return entry
+
+    def put(self, key: str, entry: dict):
+        path = self._entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+        self.size_bytes -= self._index.pop(path, 0)
+        self._index[path] = os.path.getsize(path)
+        self.size_bytes += self._index[path]
+        if self.size_bytes > self.max_size_bytes:
+            self._evict()
+
+    def _evict(self):
+        target_size_bytes = self.max_size_bytes * self.low_water_mark
+        while self.size_bytes > target_size_bytes and len(self._index) > 0:
+            path, size = self._index.popitem(last=False)
+            self.size_bytes -= size
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+
+def compact_generation_metadata(seq_metadata) -> dict:
+    return {
+        "score": seq_metadata["score"],
+        # Only keep the token ids of the dropped sequences
+        "dropped_seqs": [
+            [dropped_seq[0].tolist()] for dropped_seq in seq_metadata["dropped_seqs"]
+        ],
+        "n_words_checked": seq_metadata["n_words_checked"],
+        "num_tokens": seq_metadata["num_tokens"],
+    }
+
+
+def generate_summaries_with_cache(
+    generation_cache: Optional[GenerationCache],
+    model,
+    tokenizer,
+    docs_to_summarize: List[str],
+    banned_phrases_by_input_idx: Dict[int, set],
+    num_beams=4,
+    input_ids: Optional[List[List[int]]] = None,
+    max_lengths: Optional[List[int]] = None,
+    inputs: Optional[BatchEncoding] = None,
+):
+    """
+    Constrained generation with `generate_summaries` that only decodes
+    the docs that aren't in the generation cache.
+
+    `inputs` optionally holds all docs tokenized by `tokenize_docs`,
+    only the rows of the docs that are decoded are passed on.
+
+    Returns summaries with compact generation metadata
+    (score, dropped sequences, number of checked words & generated tokens).
+    """
+    summaries: List[Optional[str]] = [None] * len(docs_to_summarize)
+    metadata: List[Optional[dict]] = [None] * len(docs_to_summarize)
+    keys = []
+    if generation_cache is not None:
+        model_id = get_model_id(model)
+        for idx, doc in enumerate(docs_to_summarize):
+            keys.append(
+                GenerationCache.key(
+                    model_id,
+                    doc,
+                    num_beams,
+                    banned_phrases_by_input_idx[idx],
+                    max_lengths[idx] if max_lengths is not None else None,
+                )
+            )
+            entry = generation_cache.get(keys[idx])
+            if entry is not None:
+                summaries[idx] = entry["summary"]
+                metadata[idx] = entry["generation_metadata"]
+
+    missing_idxs = [idx for idx, summary in enumerate(summaries) if summary is None]
+    if len(missing_idxs) == 0:
+        return summaries, metadata
+
+    factuality_enforcer = WordLogitsProcessor(
+        tokenizer,
+        num_beams,
+        BannedPhrases(
+            banned_phrases_by_input_idx={
+                local_idx: banned_phrases_by_input_idx[idx]
+                for local_idx, idx in enumerate(missing_idxs)
+            }
+        ),
+    )
+    gen_summaries, gen_metadata = generate_summaries(
+        model,
+        tokenizer,
+        [docs_to_summarize[idx] for idx in missing_idxs],
+        factuality_enforcer,
+        num_beams=num_beams,
+        return_beam_metadata=True,
+        input_ids=(
+            [input_ids[idx] for idx in missing_idxs] if input_ids is not None else None
+        ),
+        max_lengths=(
+            [max_lengths[idx] for idx in missing_idxs]
+            if max_lengths is not None
+            else None
+        ),
+        inputs=select_inputs(inputs, missing_idxs) if inputs is not None else None,
+    )
+    for local_idx, idx in enumerate(missing_idxs):
+        summaries[idx] = gen_summaries[local_idx]
+        metadata[idx] = compact_generation_metadata(gen_metadata[local_idx])
+        if generation_cache is not None:
+            generation_cache.put(
+                keys[idx],
+                {"summary": summaries[idx], "generation_metadata": metadata[idx]},
+            )
+
+    return summaries, metadata
@@ -1,11 +1,11 @@
+from typing import List, Optional
 import torch
-from transformers import AutoModelForSeq2SeqLM, AutoTokenizer, LogitsProcessorList, PegasusTokenizerFast
+from transformers import AutoModelForSeq2SeqLM, AutoTokenizer, LogitsProcessor, LogitsProcessorList, PegasusTokenizerFast
+from transformers.tokenization_utils_base import BatchEncoding
+from src.data_utils import SUMMARY_FAILED_GENERATION
 from src.word_logits_processor import WordLogitsProcessor
 
 
-SUMMARY_FAILED_GENERATION = "<Failed generation: blocked all beams>"
-
-
 def entropy(p_dist: torch.Tensor) -> float:
     """ "
     Calculates Shannon entropy for a probability distribution
@@ -21,6 +21,47 @@ def entropy(p_dist: torch.Tensor) -> float:
     return -torch.mul(p_dist, p_dist.log()).sum(0).item()
 
 
+class LengthBudgetLogitsProcessor(LogitsProcessor):
+    r"""
+    [`LengthBudgetLogitsProcessor`] forcing EOS once the beams of an input
+    reach the length budget of that input
+
+    Args:
+        max_lengths (`List[int]`):
+            Max length (incl. the decoder start token) for every input.
+        num_beams (`int`):
+            Number of beams.
+        eos_token_id (`int`):
+            The model's EOS token id.
+    """
+
+    def __init__(self, max_lengths: List[int], num_beams: int, eos_token_id: int):
+        self.max_length_by_beam = torch.tensor(max_lengths).repeat_interleave(
+            num_beams
+        )
+        self.eos_token_id = eos_token_id
+
+    def __call__(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor
+    ) -> torch.FloatTensor:
+        over_budget = (
+            input_ids.shape[-1] >= self.max_length_by_beam.to(scores.device) - 1
+        )
+        if over_budget.any():
+            scores[over_budget, :] = -float("inf")
+            scores[over_budget, self.eos_token_id] = 0
+        return scores
+
+
+def count_generated_tokens(sequence: torch.Tensor, pad_token_id: int) -> int:
+    """
+    Number of generated tokens incl. the decoder start token, i.e. the
+    `max_length` needed to generate the sequence.
+    """
+    # The decoder start token can be the pad token (Pegasus)
+    return 1 + int((sequence[1:] != pad_token_id).sum().item())
+
+
 def load_prior_model_and_tokenizer(model_name):
     return load_model_and_tokenizer(model_name)
 
@@ -39,19 +80,69 @@ def load_model_and_tokenizer(
     )
 
 
+def load_bart_xsum_cmlm_tokenizer():
+    """
+    Tokenizer of the CMLM posterior model, which marks the masked entity
+    with "###". Everything that tokenizes for the posterior (incl. the
+    token cache prefill) must use it, so that the cache namespaces match.
+    """
+    return AutoTokenizer.from_pretrained("facebook/bart-large-xsum", mask_token="###")
+
+
 def load_bart_xsum_cmlm(
     device=torch.device("cuda" if torch.cuda.is_available() else "cpu"),
 ):
     model = AutoModelForSeq2SeqLM.from_pretrained("model-checkpoints/entfa-cmlm").to(
         device
     )
-    tokenizer = AutoTokenizer.from_pretrained(
-        "facebook/bart-large-xsum", mask_token="###"
-    )
+    tokenizer = load_bart_xsum_cmlm_tokenizer()
 
     return model, tokenizer
 
 
+def tokenize_docs(
+    tokenizer, docs_to_summarize, input_ids: Optional[List[List[int]]] = None
+):
+    """
+    Tokenizes docs for summarization, truncated to the model max length.
+
+    If `input_ids` are passed (e.g. from a `TokenizationCache`), they are
+    expected to be without special tokens and tokenization is skipped.
+    """
+    if input_ids is None:
+        return tokenizer(
+            docs_to_summarize,
+            max_length=tokenizer.model_max_length,
+            truncation=True,
+            return_tensors="pt",
+            padding=True,
+        )
+    max_content_length = (
+        tokenizer.model_max_length - tokenizer.num_special_tokens_to_add()
+    )
+    return tokenizer.pad(
+        {
+            "input_ids": [
+                tokenizer.build_inputs_with_special_tokens(ids[:max_content_length])
+                for ids in input_ids
+            ]
+        },
+        return_tensors="pt",
+    )
+
+
+def select_inputs(inputs: BatchEncoding, idxs: List[int]) -> BatchEncoding:
+    """
+    Rows `idxs` of a padded batch from `tokenize_docs`, without the columns
+    that are padding in all of the selected rows.
+    """
+    selected = {key: value[idxs] for key, value in inputs.items()}
+    is_content_column = selected["attention_mask"].any(dim=0)
+    return BatchEncoding(
+        {key: value[:, is_content_column] for key, value in selected.items()}
+    )
+
+
 def generate_summaries(
     model,
     tokenizer,
@@ -60,24 +151,43 @@ def generate_summaries(
     num_beams=4,
     return_beam_metadata=False,
     device=torch.device("cuda" if torch.cuda.is_available() else "cpu"),
+    input_ids: Optional[List[List[int]]] = None,
+    max_lengths: Optional[List[int]] = None,
+    inputs: Optional[BatchEncoding] = None,
 ):
+    """
+    Generates summaries with (constrained) beam search.
+
+    `max_lengths` optionally sets a length budget per input, inputs stop
+    generating once they reach their budget.
+
+    `inputs` optionally holds the docs already tokenized by `tokenize_docs`
+    (e.g. in an earlier pipeline stage), `docs_to_summarize` & `input_ids`
+    aren't tokenized again then.
+    """
     model.to(device)
-    inputs = tokenizer(
-        docs_to_summarize,
-        max_length=tokenizer.model_max_length,
-        truncation=True,
-        return_tensors="pt",
-        padding=True,
-    )
+    if inputs is None:
+        inputs = tokenize_docs(tokenizer, docs_to_summarize, input_ids)
+    logits_processors = [] if word_logits_processor is None else [word_logits_processor]
+    generate_kwargs = {}
+    if max_lengths is not None:
+        logits_processors.append(
+            LengthBudgetLogitsProcessor(
+                max_lengths, num_beams, model.config.eos_token_id
+            )
+        )
+        generate_kwargs["max_length"] = max(max_lengths)
     model_output = model.generate(
         inputs.input_ids.to(device),
+        # padding must not change the summary of an input, which is cached
+        # per input by `generate_summaries_with_cache`
+        attention_mask=inputs.attention_mask.to(device),
         num_beams=num_beams,
         early_stopping=True,
         return_dict_in_generate=True,
         output_scores=True,
-        logits_processor=LogitsProcessorList(
-            [] if word_logits_processor is None else [word_logits_processor]
-        ),
+        logits_processor=LogitsProcessorList(logits_processors),
+        **generate_kwargs,
     )
     generated_summaries = [
         (
@@ -118,6 +228,9 @@ def generate_summaries(
                 "n_words_checked": word_logits_processor.words_to_check_by_input_idx[
                     seq_idx
                 ],
+                "num_tokens": count_generated_tokens(
+                    model_output.sequences[seq_idx], tokenizer.pad_token_id
+                ),
             }
             beams_metadata.append(seq_beams)
 
@@ -0,0 +1,209 @@
+from typing import Dict, List, Optional, Tuple
+import json
+import os
+import numpy as np
+
+ARTIFACT_FORMAT_VERSION = 1
+ARTIFACT_ARRAYS = ["mean", "scale", "train_X", "train_y", "classes", "train_sq_norms"]
+
+
+class CompiledKNNClassifier:
+    """
+    Vectorised numpy replacement of a trained
+    `Pipeline(StandardScaler, KNeighborsClassifier)` for prediction.
+
+    The training points are stored already scaled, so predicting is a
+    single scaling of the inputs, a squared distance matrix against the
+    training points & a vote of the `n_neighbors` closest ones.
+
+    Args:
+        mean (`np.ndarray`):
+            Mean of the scaler, per feature.
+        scale (`np.ndarray`):
+            Scale of the scaler, per feature.
+        train_X (`np.ndarray`):
+            Scaled training features, with shape (n_train, n_features).
+        train_y (`np.ndarray`):
+            Class index of every training point.
+        classes (`np.ndarray`):
+            Class labels, as in `KNeighborsClassifier.classes_`.
+        n_neighbors (`int`):
+            Number of neighbours that vote.
+        feature_names (`List[str]`, *optional*):
+            Order of the feature columns when predicting from a DataFrame.
+    """
+
+    def __init__(
+        self,
+        mean: np.ndarray,
+        scale: np.ndarray,
+        train_X: np.ndarray,
+        train_y: np.ndarray,
+        classes: np.ndarray,
+        n_neighbors: int,
+        feature_names: Optional[List[str]] = None,
+        train_sq_norms: Optional[np.ndarray] = None,
+    ):
+        self.mean = mean
+        self.scale = scale
+        self.train_X = train_X
+        self.train_y = train_y
+        self.classes_ = classes
+        self.n_neighbors = n_neighbors
+        self.feature_names = feature_names
+        self.train_sq_norms = (
+            train_sq_norms if train_sq_norms is not None else (train_X**2).sum(axis=1)
+        )
+
+    def _scaled(self, X) -> np.ndarray:
+        if hasattr(X, "columns") and self.feature_names is not None:
+            X = X[self.feature_names]
+        return (np.asarray(X, dtype=np.float64) - self.mean) / self.scale
+
+    def kneighbors(self, X, chunk_size: int = 4096) -> np.ndarray:
+        """
+        Indices of the `n_neighbors` closest training points, closest first.
+        """
+        X = self._scaled(X)
+        neighbors = np.empty((len(X), self.n_neighbors), dtype=np.int64)
+        for start in range(0, len(X), chunk_size):
+            chunk = X[start : start + chunk_size]
+            sq_dists = (
+                (chunk**2).sum(axis=1)[:, None]
+                - 2 * chunk @ self.train_X.T
+                + self.train_sq_norms[None, :]
+            )
+            closest = np.argpartition(sq_dists, self.n_neighbors - 1, axis=1)[
+                :, : self.n_neighbors
+            ]
+            order = np.argsort(np.take_along_axis(sq_dists, closest, axis=1), axis=1)
+            neighbors[start : start + chunk_size] = np.take_along_axis(
+                closest, order, axis=1
+            )
+        return neighbors
+
+    def predict_proba(self, X) -> np.ndarray:
+        neighbor_y = self.train_y[self.kneighbors(X)]
+        votes = np.stack(
+            [(neighbor_y == i).sum(axis=1) for i in range(len(self.classes_))], axis=1
+        )
+        return votes / self.n_neighbors
+
+    def predict(self, X) -> np.ndarray:
+        return self.classes_[self.predict_proba(X).argmax(axis=1)]
+
+    def save(self, path: str):
+        np.savez(
+            path,
+            mean=self.mean,
+            scale=self.scale,
+            train_X=self.train_X,
+            train_y=self.train_y,
+            classes=self.classes_,
+            n_neighbors=self.n_neighbors,
+            feature_names=np.array(self.feature_names or []),
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "CompiledKNNClassifier":
+        with np.load(path) as data:
+            return cls(
+                mean=data["mean"],
+                scale=data["scale"],
+                train_X=data["train_X"],
+                train_y=data["train_y"],
+                classes=data["classes"],
+                n_neighbors=int(data["n_neighbors"]),
+                feature_names=data["feature_names"].tolist() or None,
+            )
+
+    def save_artifact(
+        self,
+        artifact_dir: str,
+        label_mapping: Dict[int, str],
+        training_data_hash: str,
+        sklearn_version: str,
+    ):
+        """
+        Writes a versioned classifier artifact: a `manifest.json` with the
+        feature schema, label mapping, training data hash & sklearn version
+        next to one `.npy` file per array.
+        """
+        os.makedirs(artifact_dir, exist_ok=True)
+        for name in ARTIFACT_ARRAYS:
+            np.save(os.path.join(artifact_dir, f"{name}.npy"), self._array(name))
+        manifest = {
+            "format_version": ARTIFACT_FORMAT_VERSION,
+            "classifier": "knn",
+            "feature_names": self.feature_names,
+            "label_mapping": {str(k): v for k, v in label_mapping.items()},
+            "n_neighbors": self.n_neighbors,
+            "training_data_sha256": training_data_hash,
+            "sklearn_version": sklearn_version,
+            "arrays": {name: f"{name}.npy" for name in ARTIFACT_ARRAYS},
+        }
+        with open(os.path.join(artifact_dir, "manifest.json"), "w") as f:
+            json.dump(manifest, f, indent=2)
+
+    def _array(self, name: str) -> np.ndarray:
+        if name == "classes":
+            return np.asarray(self.classes_)
+        return np.asarray(getattr(self, name))
+
+    @classmethod
+    def load_artifact(
+        cls, artifact_dir: str, mmap: bool = True
+    ) -> Tuple["CompiledKNNClassifier", dict]:
+        """
+        Loads a classifier artifact, memory-mapping its arrays (read-only)
+        so that worker processes share the same pages.
+
+        Returns the classifier and the manifest.
+        """
+        with open(os.path.join(artifact_dir, "manifest.json"), "r") as f:
+            manifest = json.load(f)
+        if manifest["format_version"] != ARTIFACT_FORMAT_VERSION:
+            raise ValueError(
+                f"Unsupported classifier artifact version {manifest['format_version']}"
+            )
+        arrays = {
+            name: np.load(
+                os.path.join(artifact_dir, filename), mmap_mode="r" if mmap else None
+            )
+            for name, filename in manifest["arrays"].items()
+        }
+        return (
+            cls(
+                mean=arrays["mean"],
+                scale=arrays["scale"],
+                train_X=arrays["train_X"],
+                train_y=arrays["train_y"],
+                classes=arrays["classes"],
+                n_neighbors=manifest["n_neighbors"],
+                feature_names=manifest["feature_names"],
+                train_sq_norms=arrays["train_sq_norms"],
+            ),
+            manifest,
+        )
+
+
+def compile_knn_classifier(pipeline) -> CompiledKNNClassifier:
+    """
+    Compiles a trained `Pipeline(StandardScaler, KNeighborsClassifier)`
+    (as trained by `train_factuality_clf.py`).
+    """
+    scaler, knn = pipeline[0], pipeline[-1]
+    if knn.weights != "uniform" or knn.effective_metric_ != "euclidean":
+        raise ValueError("Only uniform euclidean kNN classifiers can be compiled")
+    mean = scaler.mean_ if scaler.with_mean else np.zeros(scaler.n_features_in_)
+    scale = scaler.scale_ if scaler.with_std else np.ones(scaler.n_features_in_)
+    feature_names = getattr(pipeline, "feature_names_in_", None)
+    return CompiledKNNClassifier(
+        mean=np.asarray(mean, dtype=np.float64),
+        scale=np.asarray(scale, dtype=np.float64),
+        train_X=np.asarray(knn._fit_X, dtype=np.float64),
+        train_y=np.asarray(knn._y),
+        classes=knn.classes_,
+        n_neighbors=knn.n_neighbors,
+        feature_names=list(feature_names) if feature_names is not None else None,
+    )
@@ -1,11 +1,18 @@
-from datasets import load_metric
+_rouge_metric = None
 
 
-_rouge_metric = load_metric("rouge", seed=42)
+def get_rouge_metric():
+    # loaded on first use, importing datasets & loading the metric is slow
+    global _rouge_metric
+    if _rouge_metric is None:
+        from datasets import load_metric
+
+        _rouge_metric = load_metric("rouge", seed=42)
+    return _rouge_metric
 
 
 def rouge(predictions: list, references: list):
-    results = _rouge_metric.compute(
+    results = get_rouge_metric().compute(
         predictions=predictions,
         references=references,
         use_stemmer=True,
@@ -1,7 +1,13 @@
+from typing import Optional
+import glob
+import hashlib
 import time
 import getpass
 import os
 
+# Files of a local checkpoint whose contents are the model weights
+WEIGHT_FILE_PATTERNS = ["*.bin", "*.safetensors", "*.ckpt", "*.pt"]
+
 
 class Timer(object):
     def __init__(self, message: str):
@@ -29,3 +35,40 @@ def get_new_log_path(log_folder="logs"):
                 i
             )
     return os.path.join(os.getcwd(), log_folder, f"{current_user}-{i}")
+
+
+def weights_fingerprint(name_or_path: str) -> Optional[str]:
+    """
+    Fingerprint of the weight files of a local checkpoint directory
+    (names, sizes & modification times), or None for hub model names.
+    """
+    if not os.path.isdir(name_or_path):
+        return None
+    weight_files = sorted(
+        path
+        for pattern in WEIGHT_FILE_PATTERNS
+        for path in glob.glob(os.path.join(name_or_path, pattern))
+    )
+    fingerprint = hashlib.sha256()
+    for path in weight_files:
+        stat = os.stat(path)
+        fingerprint.update(
+            f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns};".encode()
+        )
+    return fingerprint.hexdigest()[:16]
+
+
+def model_id(model, revision: Optional[str] = None) -> str:
+    """
+    Identifies a model's outputs for caching: name, config hash & weights
+    revision. The revision is `revision` if given, otherwise a fingerprint
+    of the weight files of a local checkpoint or the hub commit hash.
+    """
+    config_hash = hashlib.sha256(
+        model.config.to_json_string().encode("utf-8")
+    ).hexdigest()
+    if revision is None:
+        revision = weights_fingerprint(model.name_or_path) or getattr(
+            model.config, "_commit_hash", None
+        )
+    return f"{model.name_or_path}@{config_hash}@{revision}"
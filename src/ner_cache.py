@@ -0,0 +1,36 @@
+from typing import List, Tuple
+import hashlib
+import json
+from src.sqlite_store import SQLiteKeyValueStore
+
+# (ent, type, start, end) of a detected entity, after splitting person names
+EntitySpan = Tuple[str, str, int, int]
+
+
+class NERCache(SQLiteKeyValueStore):
+    """
+    Disk-backed (SQLite) cache of the entities spaCy detects in a summary.
+
+    Entries are keyed by the spaCy pipeline id (model name, version & whether
+    the pipeline is lean) and a hash of the summary text, and hold the raw
+    entity spans only: `in_source` depends on the document and is recomputed
+    against it on every lookup.
+
+    Args:
+        db_path (`str`):
+            Path of the SQLite database file.
+    """
+
+    def __init__(self, db_path: str):
+        super().__init__(db_path, "entity_spans", ["spans TEXT"])
+
+    @staticmethod
+    def key(model_id: str, summary: str) -> str:
+        summary_hash = hashlib.sha256(summary.encode("utf-8")).hexdigest()
+        return f"{model_id}:{summary_hash}"
+
+    def _to_row(self, spans: List[EntitySpan]) -> Tuple[str]:
+        return (json.dumps(spans),)
+
+    def _from_row(self, row: Tuple[str]) -> List[EntitySpan]:
+        return [tuple(span) for span in json.loads(row[0])]
@@ -1,7 +1,11 @@
-from typing import List, Literal
-from src.detect_entities import is_entity_contained
-from src.entity_utils import MarkedEntity, MarkedEntityLookup
-from src.entity_factuality import ANNOTATION_LABELS
+from typing import List, Literal, Optional
+from src.entity_utils import (
+    ANNOTATION_LABELS,
+    MarkedEntity,
+    MarkedEntityLookup,
+    containment_pattern,
+    is_entity_contained,
+)
 
 
 def get_entity_annotations(sum_ids, metadata):
@@ -23,9 +27,13 @@ EntityMatchType = Literal[
 
 
 def is_entity_match(
-    entity: MarkedEntity, annotation: MarkedEntity, match_type: EntityMatchType
+    entity: MarkedEntity,
+    annotation: MarkedEntity,
+    match_type: EntityMatchType,
+    entity_contained: Optional[bool] = None,
 ) -> bool:
-    entity_contained = is_entity_contained(entity["ent"], annotation["ent"])
+    if entity_contained is None:
+        entity_contained = is_entity_contained(entity["ent"], annotation["ent"])
     if (
         match_type == "strict_all"
         or (
@@ -63,10 +71,18 @@ def oracle_label_entities(
                 or entity_match_type in ["strict_intrinsic", "strict_all"]
                 else ANNOTATION_LABELS["Non-hallucinated"]
             )
+        # casefold every annotation once instead of once per entity
+        casefolded_annotations = [x["ent"].casefold() for x in annotations[bbc_id]]
         for unlabeled_entity in to_be_labeled:
-            for annotated_entity in annotations[bbc_id]:
+            pattern = containment_pattern(unlabeled_entity["ent"])
+            for annotated_entity, casefolded_annotation in zip(
+                annotations[bbc_id], casefolded_annotations
+            ):
                 if is_entity_match(
-                    unlabeled_entity, annotated_entity, entity_match_type
+                    unlabeled_entity,
+                    annotated_entity,
+                    entity_match_type,
+                    entity_contained=pattern in casefolded_annotation,
                 ):
                     unlabeled_entity["label"] = annotated_entity["label"]
         labeled_entities[bbc_id] = to_be_labeled
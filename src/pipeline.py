@@ -0,0 +1,206 @@
+from typing import Any, Callable, Dict, Iterable, Iterator, List, NamedTuple
+from queue import Empty, Full, Queue
+import threading
+import time
+
+
+class PipelineStage(NamedTuple):
+    name: str
+    fn: Callable[[Any], Any]
+    num_workers: int = 1
+
+
+_DONE = object()
+# how often blocked workers check whether the pipeline was stopped
+_POLL_INTERVAL_S = 0.05
+
+
+class _StageError(NamedTuple):
+    exception: BaseException
+
+
+class StagedPipeline:
+    """
+    Runs items through a sequence of stages, where every stage has its own
+    worker threads connected to the next stage by a bounded queue.
+
+    While the model decodes batch k in the generation stage, batch k+1 can
+    be tokenized and batch k-1 can go through NER/classification. Results
+    are yielded in input order, so the consumer sees the same order as
+    when running the stages sequentially.
+
+    Torch, tokenizers & spaCy release the GIL in their heavy kernels, so
+    threads are enough to overlap the stages without copying models
+    between processes.
+
+    Args:
+        stages (`List[PipelineStage]`):
+            Stages to run, in order.
+        queue_size (`int`):
+            Max number of items waiting in front of each stage. With a
+            queue size of 0 the stages run sequentially in the caller's thread.
+    """
+
+    def __init__(self, stages: List[PipelineStage], queue_size: int = 2):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.busy_time_by_stage: Dict[str, float] = {s.name: 0.0 for s in stages}
+        self.wall_time = 0.0
+        self._lock = threading.Lock()
+
+    def _record_busy_time(self, stage_name: str, elapsed_time: float):
+        with self._lock:
+            self.busy_time_by_stage[stage_name] += elapsed_time
+
+    def _run_stage_fn(self, stage: PipelineStage, item):
+        start_time = time.time()
+        try:
+            return stage.fn(item)
+        finally:
+            self._record_busy_time(stage.name, time.time() - start_time)
+
+    def _run_sequentially(self, items: Iterable) -> Iterator:
+        for item in items:
+            for stage in self.stages:
+                item = self._run_stage_fn(stage, item)
+            yield item
+
+    @staticmethod
+    def _put(q: Queue, entry, stop: threading.Event) -> bool:
+        while not stop.is_set():
+            try:
+                q.put(entry, timeout=_POLL_INTERVAL_S)
+                return True
+            except Full:
+                pass
+        return False
+
+    @staticmethod
+    def _get(q: Queue, stop: threading.Event):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=_POLL_INTERVAL_S)
+            except Empty:
+                pass
+        return _DONE
+
+    def _stage_worker(
+        self,
+        stage: PipelineStage,
+        q_in: Queue,
+        q_out: Queue,
+        state,
+        stop: threading.Event,
+    ):
+        while True:
+            entry = self._get(q_in, stop)
+            if stop.is_set():
+                return
+            if entry is _DONE:
+                # let the other workers of this stage see the sentinel too
+                self._put(q_in, _DONE, stop)
+                with self._lock:
+                    state["n_running"] -= 1
+                    is_last_worker = state["n_running"] == 0
+                if is_last_worker:
+                    self._put(q_out, _DONE, stop)
+                return
+            idx, item = entry
+            if not isinstance(item, _StageError):
+                try:
+                    item = self._run_stage_fn(stage, item)
+                except BaseException as e:
+                    item = _StageError(e)
+            if not self._put(q_out, (idx, item), stop):
+                return
+
+    def _run_threaded(self, items: Iterable) -> Iterator:
+        queues = [Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        # Set when the consumer stops early (stage error, break, exception in
+        # the caller), so the workers don't stay blocked on full queues
+        stop = threading.Event()
+        threads = []
+        for stage_idx, stage in enumerate(self.stages):
+            state = {"n_running": stage.num_workers}
+            for worker_idx in range(stage.num_workers):
+                threads.append(
+                    threading.Thread(
+                        target=self._stage_worker,
+                        args=(
+                            stage,
+                            queues[stage_idx],
+                            queues[stage_idx + 1],
+                            state,
+                            stop,
+                        ),
+                        name=f"pipeline-{stage.name}-{worker_idx}",
+                        daemon=True,
+                    )
+                )
+
+        def feed():
+            for idx, item in enumerate(items):
+                if not self._put(queues[0], (idx, item), stop):
+                    return
+            self._put(queues[0], _DONE, stop)
+
+        threads.append(threading.Thread(target=feed, name="pipeline-feed", daemon=True))
+        for thread in threads:
+            thread.start()
+
+        try:
+            # Stages with several workers can finish items out of order,
+            # buffer them until it's their turn
+            next_idx = 0
+            finished = {}
+            while True:
+                entry = queues[-1].get()
+                if entry is _DONE:
+                    break
+                idx, item = entry
+                finished[idx] = item
+                while next_idx in finished:
+                    item = finished.pop(next_idx)
+                    if isinstance(item, _StageError):
+                        raise item.exception
+                    yield item
+                    next_idx += 1
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+    def run(self, items: Iterable) -> Iterator:
+        """
+        Yields the output of the last stage for every item, in input order.
+        """
+        start_time = time.time()
+        try:
+            if self.queue_size <= 0:
+                yield from self._run_sequentially(items)
+            else:
+                yield from self._run_threaded(items)
+        finally:
+            self.wall_time += time.time() - start_time
+
+    def utilisation(self) -> Dict[str, float]:
+        """
+        Fraction of wall time that the workers of each stage were busy.
+        """
+        return {
+            stage.name: (
+                self.busy_time_by_stage[stage.name]
+                / (self.wall_time * stage.num_workers)
+                if self.wall_time > 0
+                else 0.0
+            )
+            for stage in self.stages
+        }
+
+    def print_utilisation(self):
+        print(f"[Pipeline]: {self.wall_time:.2f}s wall time")
+        for stage_name, utilisation in self.utilisation().items():
+            print(
+                f"[Pipeline]: - {stage_name}: {utilisation:.1%} busy "
+                + f"({self.busy_time_by_stage[stage_name]:.2f}s)"
+            )
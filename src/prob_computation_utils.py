@@ -1,4 +1,5 @@
-from typing import List, Tuple, TypedDict
+from typing import List, Set, Tuple, TypedDict
+import re
 from src.data_utils import XEntExample
 from src.entity_utils import MarkedEntity
 
@@ -100,3 +101,55 @@ def build_masked_inputs_and_targets_for_inference(
             sources.append(source)
 
     return inputs, targets, entities, sources
+
+
+def split_sentences(text: str) -> List[str]:
+    return [x for x in re.split(r"(?<=[.!?])\s+", text.strip()) if x]
+
+
+def lexical_tokens(text: str) -> Set[str]:
+    return set(re.findall(r"\w+", text.lower()))
+
+
+def window_sources(
+    masked_inputs: List[str],
+    entities: List[str],
+    sources: List[str],
+    tokenizer,
+    max_source_tokens: int,
+) -> List[str]:
+    """
+    For every masked input, keeps only the source sentences with the highest
+    lexical overlap with the masked summary and entity, as long as they fit
+    into `max_source_tokens` tokens. Kept sentences stay in source order.
+    """
+    sentences_by_source = {
+        source: split_sentences(source) for source in dict.fromkeys(sources)
+    }
+    all_sentences = list(
+        dict.fromkeys(
+            x for sentences in sentences_by_source.values() for x in sentences
+        )
+    )
+    n_tokens_by_sentence = {}
+    if len(all_sentences) > 0:
+        sentence_ids = tokenizer(all_sentences, add_special_tokens=False)["input_ids"]
+        n_tokens_by_sentence = {
+            sentence: len(ids) for sentence, ids in zip(all_sentences, sentence_ids)
+        }
+
+    windowed_sources = []
+    for masked_input, entity, source in zip(masked_inputs, entities, sources):
+        query = lexical_tokens(masked_input.replace("<mask>", " ") + " " + entity)
+        sentences = sentences_by_source[source]
+        overlaps = [len(query & lexical_tokens(x)) for x in sentences]
+        # most overlapping first, earlier sentences first on ties
+        ranked_idxs = sorted(range(len(sentences)), key=lambda i: (-overlaps[i], i))
+
+        kept_idxs, n_tokens = [], 0
+        for idx in ranked_idxs:
+            if n_tokens + n_tokens_by_sentence[sentences[idx]] <= max_source_tokens:
+                kept_idxs.append(idx)
+                n_tokens += n_tokens_by_sentence[sentences[idx]]
+        windowed_sources.append(" ".join(sentences[idx] for idx in sorted(kept_idxs)))
+    return windowed_sources
@@ -0,0 +1,82 @@
+from typing import Any, Dict, List, Tuple
+import os
+import sqlite3
+
+
+class SQLiteKeyValueStore:
+    """
+    Base of the disk-backed (SQLite) caches: a single table with a text
+    primary key and `value_columns`, with batched lookups & inserts and
+    hit/miss counts.
+
+    Subclasses define the table & key, and convert values to & from rows
+    with `_to_row` / `_from_row`.
+
+    Args:
+        db_path (`str`):
+            Path of the SQLite database file.
+        table (`str`):
+            Name of the table.
+        value_columns (`List[str]`):
+            Column definitions of the values, e.g. `["spans TEXT"]`.
+    """
+
+    def __init__(self, db_path: str, table: str, value_columns: List[str]):
+        self.db_path = db_path
+        self.table = table
+        self.value_columns = [column.split()[0] for column in value_columns]
+        self.hits = 0
+        self.misses = 0
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        # Accessed from the pipeline's worker threads too, and possibly from
+        # several worker processes, which wait for each other's writes
+        self.conn = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+        self.conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} "
+            + f"(key TEXT PRIMARY KEY, {', '.join(value_columns)})"
+        )
+        self.conn.commit()
+
+    def _to_row(self, value: Any) -> Tuple:
+        return tuple(value)
+
+    def _from_row(self, row: Tuple) -> Any:
+        return row
+
+    def get_many(self, keys: List[str]) -> Dict[str, Any]:
+        """
+        Returns the values of the keys that are in the store.
+        """
+        found = {}
+        unique_keys = list(dict.fromkeys(keys))
+        # stay below SQLite's max number of query parameters
+        for i in range(0, len(unique_keys), 500):
+            chunk = unique_keys[i : i + 500]
+            rows = self.conn.execute(
+                f"SELECT key, {', '.join(self.value_columns)} FROM {self.table} "
+                + f"WHERE key IN ({','.join('?' * len(chunk))})",
+                chunk,
+            ).fetchall()
+            for row in rows:
+                found[row[0]] = self._from_row(tuple(row[1:]))
+        n_hits = sum(1 for key in keys if key in found)
+        self.hits += n_hits
+        self.misses += len(keys) - n_hits
+        return found
+
+    def put_many(self, entries: Dict[str, Any]):
+        placeholders = ", ".join("?" * (len(self.value_columns) + 1))
+        self.conn.executemany(
+            f"INSERT OR REPLACE INTO {self.table} VALUES ({placeholders})",
+            [(key, *self._to_row(value)) for key, value in entries.items()],
+        )
+        self.conn.commit()
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,137 @@
+from typing import Dict, List, Tuple
+import hashlib
+import json
+import os
+import weakref
+import numpy as np
+
+
+def source_hash(text: str) -> str:
+    """
+    Stable document id for sources that don't come with an XSum id
+    (e.g. XEnt examples).
+    """
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class TokenizationCache:
+    """
+    On-disk cache of truncated input ids per (tokenizer, document id).
+
+    Ids are stored without special tokens and truncated to
+    `tokenizer.model_max_length`, so the same entry can be used both as
+    a summarization model input and as the source part of the posterior
+    model input. All ids for a tokenizer live in a single flat int32 file
+    that is memory-mapped for reading, with a JSON index of
+    document id -> (offset, length).
+
+    Args:
+        cache_dir (`str`):
+            Directory holding one sub-directory per tokenizer.
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        self._index_by_tokenizer: Dict[str, Dict[str, Tuple[int, int]]] = {}
+        self._ids_by_tokenizer: Dict[str, np.memmap] = {}
+        # tokenizer -> cache namespace, computed once per tokenizer object
+        self._namespace_by_tokenizer = weakref.WeakKeyDictionary()
+
+    def _tokenizer_dir(self, tokenizer_name: str) -> str:
+        return os.path.join(self.cache_dir, tokenizer_name.replace("/", "-"))
+
+    def _load(self, tokenizer_name: str):
+        if tokenizer_name in self._index_by_tokenizer:
+            return
+        tokenizer_dir = self._tokenizer_dir(tokenizer_name)
+        index_path = os.path.join(tokenizer_dir, "index.json")
+        if os.path.exists(index_path):
+            with open(index_path, "r") as f:
+                self._index_by_tokenizer[tokenizer_name] = {
+                    doc_id: tuple(span) for doc_id, span in json.load(f).items()
+                }
+        else:
+            self._index_by_tokenizer[tokenizer_name] = {}
+        self._open_ids(tokenizer_name)
+
+    def _open_ids(self, tokenizer_name: str):
+        ids_path = os.path.join(self._tokenizer_dir(tokenizer_name), "ids.bin")
+        if os.path.exists(ids_path) and os.path.getsize(ids_path) > 0:
+            self._ids_by_tokenizer[tokenizer_name] = np.memmap(
+                ids_path, dtype=np.int32, mode="r"
+            )
+
+    def _append(self, tokenizer_name: str, ids_by_doc_id: Dict[str, List[int]]):
+        tokenizer_dir = self._tokenizer_dir(tokenizer_name)
+        os.makedirs(tokenizer_dir, exist_ok=True)
+        index = self._index_by_tokenizer[tokenizer_name]
+        ids_path = os.path.join(tokenizer_dir, "ids.bin")
+        offset = os.path.getsize(ids_path) // 4 if os.path.exists(ids_path) else 0
+        with open(ids_path, "ab") as f:
+            for doc_id, ids in ids_by_doc_id.items():
+                f.write(np.asarray(ids, dtype=np.int32).tobytes())
+                index[doc_id] = (offset, len(ids))
+                offset += len(ids)
+        # a crash mid-write must not leave a truncated index behind
+        index_path = os.path.join(tokenizer_dir, "index.json")
+        with open(index_path + ".tmp", "w") as f:
+            json.dump(index, f)
+        os.replace(index_path + ".tmp", index_path)
+        self._open_ids(tokenizer_name)
+
+    def _tokenizer_namespace(self, tokenizer) -> str:
+        """
+        Tokenizer name with a hash of its vocab, special tokens & max length,
+        since tokenizers of the same name can tokenize differently (e.g. the
+        CMLM tokenizer with `mask_token="###"`).
+        """
+        if tokenizer not in self._namespace_by_tokenizer:
+            fingerprint = hashlib.sha1(
+                json.dumps(
+                    [
+                        sorted(tokenizer.get_vocab().items()),
+                        tokenizer.special_tokens_map,
+                        tokenizer.model_max_length,
+                    ],
+                    sort_keys=True,
+                    default=str,
+                ).encode("utf-8")
+            ).hexdigest()[:16]
+            self._namespace_by_tokenizer[tokenizer] = (
+                f"{tokenizer.name_or_path}@{fingerprint}"
+            )
+        return self._namespace_by_tokenizer[tokenizer]
+
+    def get_or_tokenize(
+        self, tokenizer, doc_ids: List[str], docs: List[str]
+    ) -> List[List[int]]:
+        """
+        Returns truncated input ids (without special tokens) for every doc,
+        tokenizing & persisting only the docs that aren't cached yet.
+        """
+        tokenizer_name = self._tokenizer_namespace(tokenizer)
+        self._load(tokenizer_name)
+        index = self._index_by_tokenizer[tokenizer_name]
+
+        missing = {
+            doc_id: doc for doc_id, doc in zip(doc_ids, docs) if doc_id not in index
+        }
+        if len(missing) > 0:
+            tokenized = tokenizer(
+                list(missing.values()),
+                max_length=tokenizer.model_max_length,
+                truncation=True,
+                add_special_tokens=False,
+            )
+            self._append(
+                tokenizer_name, dict(zip(missing.keys(), tokenized["input_ids"]))
+            )
+
+        ids = self._ids_by_tokenizer.get(
+            tokenizer_name, np.zeros(0, dtype=np.int32)
+        )
+        result = []
+        for doc_id in doc_ids:
+            offset, length = index[doc_id]
+            result.append(ids[offset : offset + length].tolist())
+        return result
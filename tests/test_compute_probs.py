@@ -1,8 +1,12 @@
+import json
+import time
 import numpy as np
 import pandas as pd
 import pytest
 from compute_probs import (build_masked_inputs_and_targets,
+                           compute_prior_probs_for_batch,
                            compute_probs_for_summary)
+from src.prob_computation_utils import build_causal_masked_inputs_and_targets
 from src.generation_utils import (load_bart_xsum_cmlm,
                                   load_prior_model_and_tokenizer)
 
@@ -39,30 +43,33 @@ def long_entity_data():
 
 
 @pytest.fixture(scope="module")
-def masked_multiple_entity_data():
-    return build_masked_inputs_and_targets(
-        {
-            "source": 'The 58-year-old spent three months in charge of the Addicks at the end of the 2013-14 campaign, keeping the club in the Championship. Since leaving The Valley the Belgian has spent time in charge of Blackpool, Standard Liege and Metz. Riga replaces compatriot Karel Fraeye, who was sacked from his post as interim head coach on Wednesday. Charlton are currently 23rd in the Championship table, three points from safety, and are on a run of 10 games without a win in all competitions. Fraeye was appointed in late October following the departure of Guy Luzon, but only won two of his 14 matches in charge of the first team. In a statement on the club website, Addicks owner Roland Duchatelet admitted the club had made errors in player recruitment and said the board of directors accepted responsibility for "a disappointing season". "It was crucial we dealt with the position of the head coach," the Belgian businessman added. "Jose did an excellent job in his short period with Charlton two seasons ago. He was very popular with supporters and I believe that he will get us back on track." Riga won seven of his 16 games during his stint at The Valley in 2014 but left the south-east London club when his contract was not renewed that summer and joined Blackpool. BBC Radio London\'s Andy Rowley. Charlton fans are increasingly angry with how the club is being run by Roland Duchatelet, who is now onto his sixth head coach since taking over the club in January 2014. There have been a number of recent protests at The Valley aimed at Duchatelet and chief executive Katrien Meire from supporters, who have now come together to form a group called "Coalition Against Roland Duchatelet" in an attempt to bring about a sale of the club. Riga has far more managerial experience than his predecessor Karel Fraeye but, given his previous links to Duchatelet and the antipathy towards the board of directors, the appointment could only serve to fan the flames for further supporter unrest.',
-            "reference": "Championship strugglers Charlton Athletic have reappointed Jose Riga as head coach on an 18-month deal.",
-            "prediction": "Charlton Athletic have appointed Jose Riga as their new head coach on a two-year contract.",
-            "entities": [
-                {
-                    "start": 33,
-                    "end": 42,
-                    "label": "Non-hallucinated",
-                    "type": "GPE",
-                    "ent": "Jose Riga",
-                },
-                {
-                    "start": 72,
-                    "end": 80,
-                    "label": "Non-factual Hallucination",
-                    "type": "DATE",
-                    "ent": "two-year",
-                },
-            ],
-        }
-    )
+def multiple_entity_example():
+    return {
+        "source": 'The 58-year-old spent three months in charge of the Addicks at the end of the 2013-14 campaign, keeping the club in the Championship. Since leaving The Valley the Belgian has spent time in charge of Blackpool, Standard Liege and Metz. Riga replaces compatriot Karel Fraeye, who was sacked from his post as interim head coach on Wednesday. Charlton are currently 23rd in the Championship table, three points from safety, and are on a run of 10 games without a win in all competitions. Fraeye was appointed in late October following the departure of Guy Luzon, but only won two of his 14 matches in charge of the first team. In a statement on the club website, Addicks owner Roland Duchatelet admitted the club had made errors in player recruitment and said the board of directors accepted responsibility for "a disappointing season". "It was crucial we dealt with the position of the head coach," the Belgian businessman added. "Jose did an excellent job in his short period with Charlton two seasons ago. He was very popular with supporters and I believe that he will get us back on track." Riga won seven of his 16 games during his stint at The Valley in 2014 but left the south-east London club when his contract was not renewed that summer and joined Blackpool. BBC Radio London\'s Andy Rowley. Charlton fans are increasingly angry with how the club is being run by Roland Duchatelet, who is now onto his sixth head coach since taking over the club in January 2014. There have been a number of recent protests at The Valley aimed at Duchatelet and chief executive Katrien Meire from supporters, who have now come together to form a group called "Coalition Against Roland Duchatelet" in an attempt to bring about a sale of the club. Riga has far more managerial experience than his predecessor Karel Fraeye but, given his previous links to Duchatelet and the antipathy towards the board of directors, the appointment could only serve to fan the flames for further supporter unrest.',
+        "reference": "Championship strugglers Charlton Athletic have reappointed Jose Riga as head coach on an 18-month deal.",
+        "prediction": "Charlton Athletic have appointed Jose Riga as their new head coach on a two-year contract.",
+        "entities": [
+            {
+                "start": 33,
+                "end": 42,
+                "label": "Non-hallucinated",
+                "type": "GPE",
+                "ent": "Jose Riga",
+            },
+            {
+                "start": 72,
+                "end": 80,
+                "label": "Non-factual Hallucination",
+                "type": "DATE",
+                "ent": "two-year",
+            },
+        ],
+    }
+
+
+@pytest.fixture(scope="module")
+def masked_multiple_entity_data(multiple_entity_example):
+    return build_masked_inputs_and_targets(multiple_entity_example)
 
 
 @pytest.fixture(scope="module")
@@ -249,3 +256,186 @@ def test_prior_and_posterior_masked(bart_large, bart_large_xsum, evaluation_repr
         results.loc[factual_ents, "prior_prob"]
         < results.loc[factual_ents, "posterior_prob"]
     )
+
+
+def test_teacher_forced_matches_generate(
+    bart_large, bart_large_xsum, evaluation_repro_data, masked_multiple_entity_data
+):
+    for data in [evaluation_repro_data, masked_multiple_entity_data]:
+        inputs, targets, entities, sources, _labels = data
+        entity_probs_by_scoring = {}
+        for scoring in ["generate", "teacher_forced"]:
+            start_time = time.time()
+            entity_probs_by_scoring[scoring] = compute_probs_for_summary(
+                masked_inputs=inputs,
+                targets=targets,
+                sources=sources,
+                entities=entities,
+                prior_model_and_tokenizer=bart_large,
+                posterior_model_and_tokenizer=bart_large_xsum,
+                scoring=scoring,
+            )
+            print(f"{scoring} scoring took {time.time() - start_time:.2f}s")
+
+        assert np.allclose(
+            entity_probs_by_scoring["generate"],
+            entity_probs_by_scoring["teacher_forced"],
+            rtol=1e-3,
+            atol=1e-6,
+        )
+
+
+def test_teacher_forced_matches_stored_probs(bart_large, bart_large_xsum):
+    # data/xent-probs was computed with the original per-token softmax loop
+    with open("data/xent-probs/test.json") as f:
+        examples = json.load(f)[:3]
+
+    for example in examples:
+        inputs, targets, entities, sources, _labels = build_masked_inputs_and_targets(
+            example
+        )
+        entity_probs = compute_probs_for_summary(
+            masked_inputs=inputs,
+            targets=targets,
+            sources=sources,
+            entities=entities,
+            prior_model_and_tokenizer=bart_large,
+            posterior_model_and_tokenizer=bart_large_xsum,
+        )
+        # probabilities were stored by entity text, as by `add_probs_to_example`
+        probs_by_entity = dict(zip(entities, entity_probs))
+        for entity in example["entities"]:
+            # the stored probabilities may come from different hardware
+            assert np.allclose(
+                probs_by_entity[entity["ent"]],
+                (entity["prior_prob"], entity["posterior_prob"]),
+                rtol=1e-2,
+                atol=1e-5,
+            ), entity["ent"]
+
+
+def test_log_probs(bart_large, bart_large_xsum, long_entity_data):
+    inputs, targets, entities, sources, _labels = long_entity_data
+
+    entity_probs = compute_probs_for_summary(
+        masked_inputs=inputs,
+        targets=targets,
+        sources=sources,
+        entities=entities,
+        prior_model_and_tokenizer=bart_large,
+        posterior_model_and_tokenizer=bart_large_xsum,
+        return_log_probs=True,
+    )
+
+    for prior, posterior, prior_log, posterior_log in entity_probs:
+        assert np.isclose(np.exp(prior_log), prior)
+        assert np.isclose(np.exp(posterior_log), posterior)
+        assert prior_log < 0 and posterior_log < 0
+
+
+def test_causal_prior_mode(
+    bart_large, bart_large_xsum, multiple_entity_example, masked_multiple_entity_data
+):
+    inputs, targets, entities, sources, _labels = masked_multiple_entity_data
+
+    masked_probs = compute_probs_for_summary(
+        masked_inputs=inputs,
+        targets=targets,
+        sources=sources,
+        entities=entities,
+        prior_model_and_tokenizer=bart_large,
+        posterior_model_and_tokenizer=bart_large_xsum,
+        return_log_probs=True,
+    )
+    causal_probs = compute_probs_for_summary(
+        masked_inputs=inputs,
+        targets=targets,
+        sources=sources,
+        entities=entities,
+        prior_model_and_tokenizer=bart_large,
+        posterior_model_and_tokenizer=bart_large_xsum,
+        prior_mode="causal",
+        return_log_probs=True,
+    )
+
+    # the same as scoring the per-entity causal masked inputs
+    (
+        causal_inputs,
+        causal_targets,
+        causal_entities,
+    ) = build_causal_masked_inputs_and_targets(multiple_entity_example)
+    expected_probs, expected_log_probs = compute_prior_probs_for_batch(
+        causal_inputs,
+        causal_targets,
+        causal_entities,
+        bart_large,
+        bart_large[0].device,
+    )
+
+    assert len(causal_probs) == len(inputs)
+    assert np.allclose([x[0] for x in causal_probs], expected_probs, rtol=1e-4)
+    assert np.allclose([x[2] for x in causal_probs], expected_log_probs, atol=1e-4)
+    # the posterior doesn't depend on the prior mode
+    assert np.allclose([x[1] for x in masked_probs], [x[1] for x in causal_probs])
+
+
+def test_shared_prefix_prior_mode(
+    bart_large, bart_large_xsum, multiple_entity_example, masked_multiple_entity_data
+):
+    inputs, targets, entities, sources, _labels = masked_multiple_entity_data
+
+    shared_prefix_probs = compute_probs_for_summary(
+        masked_inputs=inputs,
+        targets=targets,
+        sources=sources,
+        entities=entities,
+        prior_model_and_tokenizer=bart_large,
+        posterior_model_and_tokenizer=bart_large_xsum,
+        prior_mode="shared_prefix",
+        return_log_probs=True,
+    )
+
+    # one pass over the full summary scores every entity as if the summary
+    # was cut at the end of the entity, with only <mask> in the encoder
+    _causal_inputs, causal_targets, causal_entities = (
+        build_causal_masked_inputs_and_targets(multiple_entity_example)
+    )
+    expected_probs, expected_log_probs = compute_prior_probs_for_batch(
+        ["<mask>"] * len(causal_targets),
+        causal_targets,
+        causal_entities,
+        bart_large,
+        bart_large[0].device,
+    )
+
+    assert len(shared_prefix_probs) == len(inputs)
+    assert np.allclose([x[0] for x in shared_prefix_probs], expected_probs, rtol=1e-4)
+    assert np.allclose(
+        [x[2] for x in shared_prefix_probs], expected_log_probs, atol=1e-4
+    )
+
+
+def test_max_tokens_batching_keeps_order(
+    bart_large, bart_large_xsum, masked_multiple_entity_data
+):
+    inputs, targets, entities, sources, _labels = masked_multiple_entity_data
+
+    fixed_probs = compute_probs_for_summary(
+        masked_inputs=inputs,
+        targets=targets,
+        sources=sources,
+        entities=entities,
+        prior_model_and_tokenizer=bart_large,
+        posterior_model_and_tokenizer=bart_large_xsum,
+    )
+    packed_probs = compute_probs_for_summary(
+        masked_inputs=inputs,
+        targets=targets,
+        sources=sources,
+        entities=entities,
+        prior_model_and_tokenizer=bart_large,
+        posterior_model_and_tokenizer=bart_large_xsum,
+        max_tokens=2048,
+    )
+
+    assert np.allclose(fixed_probs, packed_probs, rtol=1e-3, atol=1e-6)
@@ -1,4 +1,4 @@
-from src.detect_entities import detect_entities
+from src.detect_entities import detect_entities, detect_entities_batch
 
 
 def test_ner_detection():
@@ -99,3 +99,25 @@ def test_split_person_st():
     assert entities[0]["type"] == "PERSON"
     assert not entities[0]["in_source"]
     assert summary[entities[0]["start"] : entities[0]["end"]] == entities[0]["ent"]
+
+
+def test_lean_pipeline():
+    from src.detect_entities import get_nlp
+
+    assert "ner" in get_nlp().pipe_names
+    assert "parser" not in get_nlp().pipe_names
+    assert "lemmatizer" not in get_nlp().pipe_names
+
+
+def test_batch_detection_matches_single():
+    pairs = [
+        ("A search is under way for Daniel Levenson", "Pembrokeshire"),
+        (
+            "A search is under way for the remains of a Pembrokeshire village.",
+            "Pembrokeshire",
+        ),
+        ("No entities here.", ""),
+    ]
+    assert detect_entities_batch(pairs, batch_size=2) == [
+        detect_entities(summary, source) for summary, source in pairs
+    ]
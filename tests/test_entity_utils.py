@@ -0,0 +1,38 @@
+import json
+from benchmark_containment import regex_contained_in
+from src.entity_utils import entities_contained_in, is_entity_contained
+
+
+def test_contained_entities_match_single_checks():
+    source = "The BBC's Wales correspondent visited St Davids in Pembrokeshire."
+    entities = [
+        "BBC",
+        "bbc's",
+        "Pembrokeshire",
+        "Wales's",
+        "St Davids",
+        "Cardiff",
+        "Davids in",
+        "",
+    ]
+    contained = entities_contained_in(entities, source)
+    for entity in entities:
+        assert (entity in contained) == is_entity_contained(entity, source)
+    assert "Cardiff" not in contained
+    assert "Wales's" in contained
+
+
+def test_matches_regex_containment_on_xent():
+    with open("data/xent-probs/test.json") as f:
+        dataset = json.load(f)
+    for example in dataset:
+        entities = [x["ent"] for x in example["entities"]]
+        assert entities_contained_in(entities, example["source"]) == (
+            regex_contained_in(entities, example["source"])
+        )
+
+
+def test_casefold_differs_from_regex_for_non_ascii():
+    entities = ["Straße"]
+    assert entities_contained_in(entities, "THE STRASSE") == {"Straße"}
+    assert regex_contained_in(entities, "THE STRASSE") == set()
@@ -0,0 +1,60 @@
+from src.feature_store import ProbFeatureStore, lookup_or_compute
+
+
+def make_key(masked_input, source="source"):
+    return ProbFeatureStore.key(
+        "prior", "posterior", masked_input, "target", source, "teacher_forced", "masked"
+    )
+
+
+def test_only_missing_entries_are_computed(tmp_path):
+    store = ProbFeatureStore(str(tmp_path / "probs.sqlite"))
+    keys = [make_key("a <mask>"), make_key("b <mask>")]
+    computed_idxs = []
+
+    def compute_fn(idxs):
+        computed_idxs.extend(idxs)
+        return [(0.1 * (i + 1), 0.2, -1.0, -2.0) for i in idxs]
+
+    first = lookup_or_compute(store, keys, compute_fn)
+    assert computed_idxs == [0, 1]
+    assert store.hit_rate() == 0.0
+
+    keys.append(make_key("c <mask>"))
+    second = lookup_or_compute(store, keys, compute_fn)
+    assert computed_idxs == [0, 1, 2]
+    assert second[:2] == first
+    assert store.hits == 2 and store.misses == 3
+
+
+def test_store_is_persisted(tmp_path):
+    db_path = str(tmp_path / "probs.sqlite")
+    store = ProbFeatureStore(db_path)
+    store.put_many({make_key("a <mask>"): (0.5, 0.25, -0.69, -1.38)})
+    store.close()
+
+    reopened = ProbFeatureStore(db_path)
+    assert reopened.get_many([make_key("a <mask>")]) == {
+        make_key("a <mask>"): (0.5, 0.25, -0.69, -1.38)
+    }
+    # a different source is a different entry
+    assert reopened.get_many([make_key("a <mask>", source="other")]) == {}
+
+
+def test_model_id_changes_with_retrained_weights(tmp_path):
+    from types import SimpleNamespace
+    from src.misc_utils import model_id
+
+    weights_path = tmp_path / "pytorch_model.bin"
+    weights_path.write_bytes(b"weights")
+    model = SimpleNamespace(
+        name_or_path=str(tmp_path),
+        config=SimpleNamespace(to_json_string=lambda: '{"d_model": 1024}'),
+    )
+    first_id = model_id(model)
+    assert model_id(model) == first_id
+
+    # same config, retrained weights
+    weights_path.write_bytes(b"retrained weights")
+    assert model_id(model) != first_id
+    assert model_id(model, revision="v2").endswith("@v2")
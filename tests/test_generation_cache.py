@@ -0,0 +1,54 @@
+from datasets import load_dataset
+import pytest
+from src.generation_cache import GenerationCache, generate_summaries_with_cache
+from src.generation_utils import load_model_and_tokenizer
+
+
+@pytest.fixture(scope="session")
+def bart_xsum():
+    return load_model_and_tokenizer("facebook/bart-large-xsum")
+
+
+def test_evicts_least_recently_used(tmp_path):
+    entry = {"summary": "x" * 1000, "generation_metadata": {}}
+    cache = GenerationCache(str(tmp_path), max_size_mb=3500 / 1024 / 1024)
+    cache.put("aa01", entry)
+    cache.put("bb02", entry)
+    cache.put("cc03", entry)
+    # "aa01" becomes the most recently used entry
+    assert cache.get("aa01") is not None
+    cache.put("dd04", entry)
+
+    assert cache.size_bytes <= cache.max_size_bytes
+    assert cache.get("bb02") is None
+    assert cache.get("aa01") is not None
+    assert cache.get("dd04") is not None
+
+    # the index is rebuilt from the directory
+    reopened = GenerationCache(str(tmp_path), max_size_mb=3500 / 1024 / 1024)
+    assert reopened.size_bytes == cache.size_bytes
+
+
+def test_same_output_in_different_batches(bart_xsum, tmp_path):
+    model, tokenizer = bart_xsum
+    docs = load_dataset("xsum")["test"]["document"][0:2]
+    short_doc, long_doc = sorted(docs, key=len)
+
+    alone, _ = generate_summaries_with_cache(
+        None, model, tokenizer, [short_doc], {0: set()}
+    )
+    # padded to the longer document in a batch
+    batched, _ = generate_summaries_with_cache(
+        None, model, tokenizer, [long_doc, short_doc], {0: set(), 1: set()}
+    )
+    assert alone[0] == batched[1]
+
+    cache = GenerationCache(str(tmp_path))
+    generate_summaries_with_cache(
+        cache, model, tokenizer, [long_doc, short_doc], {0: set(), 1: set()}
+    )
+    cached, _ = generate_summaries_with_cache(
+        cache, model, tokenizer, [short_doc], {0: set()}
+    )
+    assert cached[0] == alone[0]
+    assert cache.hits == 1
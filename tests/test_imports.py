@@ -0,0 +1,23 @@
+import subprocess
+import sys
+from benchmark_import_time import HEAVY_MODULES
+
+
+def imported_heavy_modules(module):
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            f"import sys, {module}; "
+            + f"print(','.join(m for m in {HEAVY_MODULES} if m in sys.modules))",
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return result.stdout.strip()
+
+
+def test_light_modules_defer_heavy_imports():
+    for module in ["src.oracle", "src.detect_entities", "src.data_utils", "src.metrics"]:
+        assert imported_heavy_modules(module) == "", module
@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+from sklearn.neighbors import KNeighborsClassifier
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
+from src.knn_engine import CompiledKNNClassifier, compile_knn_classifier
+from train_factuality_clf import (
+    build_test_features_and_targets,
+    build_train_features_and_targets,
+    load_features,
+)
+
+
+@pytest.fixture(scope="module")
+def xent_probs_knn():
+    train_data = load_features("data/xent-probs/train.json")
+    test_data = load_features("data/xent-probs/test.json")
+
+    X_train, y_train = build_train_features_and_targets(train_data, True)
+    X_test, _ = build_test_features_and_targets(test_data, True, False)
+    model = Pipeline(
+        [
+            ("scale", StandardScaler()),
+            ("knn", KNeighborsClassifier(n_neighbors=20)),
+        ]
+    )
+    model.fit(X_train, y_train)
+    return model, X_test
+
+
+def test_compiled_matches_sklearn(xent_probs_knn):
+    model, X_test = xent_probs_knn
+    compiled = compile_knn_classifier(model)
+
+    assert (compiled.predict(X_test) == model.predict(X_test)).all()
+    assert np.allclose(compiled.predict_proba(X_test), model.predict_proba(X_test))
+    assert (compiled.classes_ == model.classes_).all()
+
+
+def test_save_and_load(xent_probs_knn, tmp_path):
+    model, X_test = xent_probs_knn
+    compiled = compile_knn_classifier(model)
+    path = str(tmp_path / "knn.npz")
+    compiled.save(path)
+
+    loaded = CompiledKNNClassifier.load(path)
+    assert loaded.feature_names == compiled.feature_names
+    assert (loaded.predict(X_test) == model.predict(X_test)).all()
+
+
+def test_artifact_is_memory_mapped(xent_probs_knn, tmp_path):
+    model, X_test = xent_probs_knn
+    artifact_dir = str(tmp_path / "knn-artifact")
+    compile_knn_classifier(model).save_artifact(
+        artifact_dir,
+        label_mapping={0: "Factual Hallucination", 1: "Non-factual Hallucination"},
+        training_data_hash="abc",
+        sklearn_version="1.0",
+    )
+
+    loaded, manifest = CompiledKNNClassifier.load_artifact(artifact_dir)
+    assert isinstance(loaded.train_X, np.memmap)
+    assert manifest["feature_names"] == list(X_test.columns)
+    assert manifest["label_mapping"]["1"] == "Non-factual Hallucination"
+    assert (loaded.predict(X_test) == model.predict(X_test)).all()
+
+
+def test_posterior_grid_covers_training_posteriors(xent_probs_knn):
+    from src.entity_factuality import POSTERIOR_GRID, posterior_grid
+
+    model, _ = xent_probs_knn
+    train_posteriors = model[-1]._fit_X[:, 1] * model[0].scale_[1] + model[0].mean_[1]
+    for clf in [model, compile_knn_classifier(model)]:
+        grid = posterior_grid(clf)
+        assert np.isclose(grid.max(), max(train_posteriors.max(), 1.0))
+        assert np.isclose(grid.min(), min(train_posteriors.min(), 0.0))
+        assert set(POSTERIOR_GRID) <= set(grid)
+        # the region where the posteriors of hallucinated entities sit
+        assert ((grid > 1e-5) & (grid < 1e-2)).sum() >= 8
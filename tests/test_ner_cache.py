@@ -0,0 +1,39 @@
+from src.detect_entities import configure_nlp, nlp_model_id
+from src.ner_cache import NERCache
+
+
+def test_spans_roundtrip_across_connections(tmp_path):
+    db_path = str(tmp_path / "ner.sqlite")
+    summary = "Daniel Levenson visited Pembrokeshire in the 1970s."
+    spans = [
+        ("Daniel", "PERSON", 0, 6),
+        ("Levenson", "PERSON", 7, 15),
+        ("Pembrokeshire", "GPE", 24, 37),
+    ]
+    key = NERCache.key("en_core_web_lg-3.4.1", summary)
+
+    cache = NERCache(db_path)
+    assert cache.get_many([key]) == {}
+    cache.put_many({key: spans})
+    cache.close()
+
+    cache = NERCache(db_path)
+    assert cache.get_many([key, key]) == {key: spans}
+    assert cache.hit_rate() == 1.0
+
+
+def test_key_depends_on_model():
+    summary = "A summary."
+    assert NERCache.key("en_core_web_sm-3.4.1", summary) != NERCache.key(
+        "en_core_web_lg-3.4.1", summary
+    )
+
+
+def test_model_id_depends_on_lean_pipeline():
+    configure_nlp("lg", lean=True)
+    lean_model_id = nlp_model_id()
+    configure_nlp("lg", lean=False)
+    full_model_id = nlp_model_id()
+    configure_nlp("lg", lean=True)
+
+    assert lean_model_id != full_model_id
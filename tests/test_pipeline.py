@@ -0,0 +1,90 @@
+import threading
+import time
+import pytest
+from src.pipeline import PipelineStage, StagedPipeline
+
+
+def add_stage_name(name, sleep_s=0.0):
+    def fn(item):
+        time.sleep(sleep_s)
+        return item + [name]
+
+    return fn
+
+
+STAGES = [
+    PipelineStage("tokenize", add_stage_name("tokenize")),
+    PipelineStage("generate", add_stage_name("generate", 0.01), num_workers=3),
+    PipelineStage("label", add_stage_name("label")),
+]
+
+
+@pytest.mark.parametrize("queue_size", [0, 1, 4])
+def test_results_in_input_order(queue_size):
+    pipeline = StagedPipeline(STAGES, queue_size)
+    results = list(pipeline.run([[i] for i in range(20)]))
+
+    assert results == [[i, "tokenize", "generate", "label"] for i in range(20)]
+    assert set(pipeline.utilisation().keys()) == {"tokenize", "generate", "label"}
+    assert all(0 <= x <= 1 for x in pipeline.utilisation().values())
+
+
+def test_stages_overlap():
+    intervals = {"a": [], "b": []}
+
+    def record_interval(name):
+        def fn(item):
+            start_time = time.perf_counter()
+            time.sleep(0.02)
+            intervals[name].append((start_time, time.perf_counter()))
+            return item + [name]
+
+        return fn
+
+    stages = [
+        PipelineStage("a", record_interval("a")),
+        PipelineStage("b", record_interval("b")),
+    ]
+    pipeline = StagedPipeline(stages, queue_size=2)
+    list(pipeline.run([[i] for i in range(10)]))
+
+    # stage "a" works on a later item while stage "b" is busy
+    assert any(
+        a_start < b_end and b_start < a_end
+        for a_start, a_end in intervals["a"]
+        for b_start, b_end in intervals["b"]
+    )
+
+
+def pipeline_threads():
+    return [t for t in threading.enumerate() if t.name.startswith("pipeline-")]
+
+
+def test_stage_error_is_raised():
+    def fail_on_three(item):
+        if item == 3:
+            raise ValueError("failed")
+        return item
+
+    pipeline = StagedPipeline([PipelineStage("fail", fail_on_three)], queue_size=2)
+    results = []
+    with pytest.raises(ValueError):
+        for x in pipeline.run(range(6)):
+            results.append(x)
+    assert results == [0, 1, 2]
+    assert pipeline_threads() == []
+
+
+def test_threads_stop_when_consumer_stops_early():
+    stages = [
+        PipelineStage("a", add_stage_name("a")),
+        PipelineStage("b", add_stage_name("b", 0.01), num_workers=2),
+    ]
+    pipeline = StagedPipeline(stages, queue_size=1)
+    results = pipeline.run([[i] for i in range(100)])
+    with pytest.raises(RuntimeError):
+        for x in results:
+            raise RuntimeError("consumer failed")
+    results.close()
+
+    assert pipeline_threads() == []
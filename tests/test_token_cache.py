@@ -0,0 +1,69 @@
+import pytest
+from transformers import AutoTokenizer
+from src.generation_utils import (
+    load_bart_xsum_cmlm_tokenizer,
+    select_inputs,
+    tokenize_docs,
+)
+from src.token_cache import TokenizationCache
+
+
+@pytest.fixture(scope="module")
+def bart_tokenizer():
+    return AutoTokenizer.from_pretrained("facebook/bart-large-xsum")
+
+
+DOCS = {
+    "1": "The city was brought to a standstill on 15 December last year.",
+    "2": "Charlton Athletic have appointed Jose Riga as their new head coach. " * 200,
+}
+
+
+def test_cached_ids_match_tokenizer(bart_tokenizer, tmp_path):
+    cache = TokenizationCache(str(tmp_path))
+    doc_ids, docs = list(DOCS.keys()), list(DOCS.values())
+
+    cached_ids = cache.get_or_tokenize(bart_tokenizer, doc_ids, docs)
+    expected = tokenize_docs(bart_tokenizer, docs)
+    from_cache = tokenize_docs(bart_tokenizer, docs, cached_ids)
+
+    assert expected.input_ids.tolist() == from_cache.input_ids.tolist()
+    assert expected.attention_mask.tolist() == from_cache.attention_mask.tolist()
+
+
+def test_cache_is_persisted(bart_tokenizer, tmp_path):
+    doc_ids, docs = list(DOCS.keys()), list(DOCS.values())
+    first_run = TokenizationCache(str(tmp_path)).get_or_tokenize(
+        bart_tokenizer, doc_ids, docs
+    )
+    # Docs aren't needed anymore once they are cached
+    second_run = TokenizationCache(str(tmp_path)).get_or_tokenize(
+        bart_tokenizer, doc_ids, ["", ""]
+    )
+
+    assert first_run == second_run
+    assert len(first_run[1]) == bart_tokenizer.model_max_length
+
+
+def test_tokenizers_with_the_same_name_are_separated(bart_tokenizer, tmp_path):
+    cmlm_tokenizer = load_bart_xsum_cmlm_tokenizer()
+    doc = "The ### is a special token of the CMLM tokenizer only."
+    cache = TokenizationCache(str(tmp_path))
+
+    bart_ids = cache.get_or_tokenize(bart_tokenizer, ["1"], [doc])
+    cmlm_ids = cache.get_or_tokenize(cmlm_tokenizer, ["1"], [doc])
+
+    assert bart_ids != cmlm_ids
+    assert cmlm_ids[0] == cmlm_tokenizer(doc, add_special_tokens=False).input_ids
+
+
+def test_selected_inputs_match_tokenizing_selected_docs(bart_tokenizer):
+    docs = list(DOCS.values())
+    batch = tokenize_docs(bart_tokenizer, docs)
+
+    # the short doc without the padding to the long doc
+    selected = select_inputs(batch, [0])
+    expected = tokenize_docs(bart_tokenizer, docs[:1])
+
+    assert selected.input_ids.tolist() == expected.input_ids.tolist()
+    assert selected.attention_mask.tolist() == expected.attention_mask.tolist()
@@ -1,11 +1,23 @@
 import argparse
+import hashlib
+import itertools
 import json
+import os
 import pickle
+import numpy as np
 import pandas as pd
+import sklearn
+import sys
+from joblib import Parallel, delayed
 from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import StandardScaler
-from sklearn.neighbors import KNeighborsClassifier
-from sklearn.metrics import classification_report
+from sklearn.neighbors import KNeighborsClassifier, NearestNeighbors
+from sklearn.metrics import (
+    classification_report,
+    f1_score,
+    precision_recall_fscore_support,
+)
+from src.knn_engine import compile_knn_classifier
 
 
 def preprocess_summary(example):
@@ -56,18 +68,61 @@ def preprocess_data(examples):
     )
 
 
-def to_nonfactual_label(example):
-    if example["entity_label"] == "Non-factual Hallucination":
-        return 1
-    else:
-        return 0
+LABEL_MAPPING = {0: "Factual Hallucination", 1: "Non-factual Hallucination"}
+
+
+def hash_files(paths):
+    sha256 = hashlib.sha256()
+    for path in paths:
+        with open(path, "rb") as f:
+            sha256.update(f.read())
+    return sha256.hexdigest()
+
+
+def load_features(json_path: str) -> pd.DataFrame:
+    """
+    Loads the entity-level rows of a probability-annotated dataset from a
+    columnar `.features.npz` file next to the JSON file, which is
+    (re)built from the JSON file when missing or when the JSON changed.
+    """
+    with open(json_path, "rb") as f:
+        json_bytes = f.read()
+    json_hash = hashlib.sha256(json_bytes).hexdigest()
+    features_path = json_path.rsplit(".json", 1)[0] + ".features.npz"
+
+    if os.path.exists(features_path):
+        with np.load(features_path) as features:
+            if str(features["source_sha256"]) == json_hash:
+                return pd.DataFrame(
+                    {
+                        "prior_prob": features["prior_prob"],
+                        "posterior_prob": features["posterior_prob"],
+                        "overlaps_source": features["overlaps_source"],
+                        "entity_label": features["entity_label"].astype(object),
+                    }
+                )
+
+    data = preprocess_data(json.loads(json_bytes))
+    np.savez(
+        features_path,
+        source_sha256=np.array(json_hash),
+        prior_prob=data["prior_prob"].to_numpy(dtype=np.float64),
+        posterior_prob=data["posterior_prob"].to_numpy(dtype=np.float64),
+        overlaps_source=data["overlaps_source"].to_numpy(dtype=bool),
+        entity_label=data["entity_label"].to_numpy(dtype=str),
+    )
+    return data
+
+
+def to_nonfactual_labels(labels: pd.Series) -> pd.Series:
+    return (labels == "Non-factual Hallucination").astype(int)
 
 
 def build_train_features_and_targets(data, ignore_intrinsic: bool):
     if ignore_intrinsic:
         data = data[data["entity_label"] != "Intrinsic Hallucination"]
 
-    targets = data.apply(to_nonfactual_label, axis=1)
+    targets = to_nonfactual_labels(data["entity_label"])
     features = data[["prior_prob", "posterior_prob", "overlaps_source"]]
 
     return features, targets
@@ -83,18 +138,121 @@ def build_test_features_and_targets(
         print("\n -- Testing only on entities that are hallucinated -- \n")
         data = data[data["entity_label"] != "Non-hallucinated"]
 
-    targets = data.apply(to_nonfactual_label, axis=1)
+    targets = to_nonfactual_labels(data["entity_label"])
     features = data[["prior_prob", "posterior_prob", "overlaps_source"]]
 
     return features, targets
 
 
+FEATURE_COLUMNS = ["prior_prob", "posterior_prob", "overlaps_source"]
+
+
+def evaluate_feature_subset(
+    X_train, y_train, X_test, y_test, feature_subset, n_neighbors_grid, weights_grid
+):
+    """
+    Evaluates every (n_neighbors, weights) config on a feature subset.
+
+    The scaled features & the neighbours of the test points are computed
+    once for the largest n_neighbors, smaller ones reuse the closest of them.
+    """
+    feature_idxs = [FEATURE_COLUMNS.index(x) for x in feature_subset]
+    scaler = StandardScaler().fit(X_train[:, feature_idxs])
+    train = scaler.transform(X_train[:, feature_idxs])
+    test = scaler.transform(X_test[:, feature_idxs])
+    distances, neighbors = (
+        NearestNeighbors(n_neighbors=max(n_neighbors_grid)).fit(train).kneighbors(test)
+    )
+    neighbor_y = y_train[neighbors]
+
+    rows = []
+    for n_neighbors, weights in itertools.product(n_neighbors_grid, weights_grid):
+        k_distances, k_y = distances[:, :n_neighbors], neighbor_y[:, :n_neighbors]
+        if weights == "distance":
+            # same as sklearn: exact matches get all the weight
+            with np.errstate(divide="ignore"):
+                vote_weights = 1.0 / k_distances
+            has_match = np.isinf(vote_weights).any(axis=1)
+            vote_weights[has_match] = np.isinf(vote_weights[has_match]).astype(float)
+        else:
+            vote_weights = np.ones_like(k_distances)
+        predictions = (
+            (vote_weights * k_y).sum(axis=1) > (vote_weights * (1 - k_y)).sum(axis=1)
+        ).astype(int)
+        precision, recall, f1, _ = precision_recall_fscore_support(
+            y_test, predictions, labels=[1], zero_division=0
+        )
+        rows.append(
+            {
+                "features": "+".join(feature_subset),
+                "n_neighbors": n_neighbors,
+                "weights": weights,
+                "accuracy": (predictions == y_test).mean(),
+                "macro_f1": f1_score(y_test, predictions, average="macro"),
+                "non_factual_precision": precision[0],
+                "non_factual_recall": recall[0],
+                "non_factual_f1": f1[0],
+            }
+        )
+    return rows
+
+
+def search(
+    X_train: pd.DataFrame,
+    y_train: pd.Series,
+    X_test: pd.DataFrame,
+    y_test: pd.Series,
+    n_neighbors_grid,
+    weights_grid,
+    feature_subsets,
+    n_jobs: int = -1,
+) -> pd.DataFrame:
+    """
+    Grid search over neighbour counts, weightings & feature subsets,
+    one parallel job per feature subset. Returns a leaderboard
+    sorted by non-factual F1.
+    """
+    X_train_np = X_train[FEATURE_COLUMNS].to_numpy(dtype=float)
+    X_test_np = X_test[FEATURE_COLUMNS].to_numpy(dtype=float)
+    y_train_np = y_train.to_numpy(dtype=int)
+    y_test_np = y_test.to_numpy(dtype=int)
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(evaluate_feature_subset)(
+            X_train_np,
+            y_train_np,
+            X_test_np,
+            y_test_np,
+            feature_subset,
+            n_neighbors_grid,
+            weights_grid,
+        )
+        for feature_subset in feature_subsets
+    )
+    return (
+        pd.DataFrame([row for rows in results for row in rows])
+        .sort_values(["non_factual_f1", "macro_f1"], ascending=False)
+        .reset_index(drop=True)
+    )
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Train kNN classifier on Xent-probs dataset"
     )
     parser.add_argument("--n_neighbors", type=int, default=20)
     parser.add_argument("--pickled_clf_path", type=str)
+    parser.add_argument(
+        "--compiled_clf_path",
+        type=str,
+        default="",
+        help="export a compiled numpy kNN (.npz) for EntityFactualityClassifier",
+    )
+    parser.add_argument(
+        "--artifact_dir",
+        type=str,
+        default="",
+        help="export a versioned, memory-mappable classifier artifact directory",
+    )
     parser.add_argument("--train_data_filepath", type=str)
     parser.add_argument("--test_data_filepath", type=str)
     parser.add_argument("--ignore_intrinsic", default=True)
@@ -105,16 +263,34 @@ if __name__ == "__main__":
         help="filter test set to only evaluate against hallucinated entitites."
         + "Enables a more fair comparison against xent-extended",
     )
+    parser.add_argument(
+        "--search",
+        default=False,
+        action="store_true",
+        help="grid search neighbour counts, weightings & feature subsets "
+        + "instead of training a single classifier",
+    )
+    parser.add_argument("--search_n_neighbors", type=str, default="5,10,15,20,30,50")
+    parser.add_argument("--search_weights", type=str, default="uniform,distance")
+    parser.add_argument(
+        "--search_feature_sets",
+        type=str,
+        default="",
+        help="comma separated feature sets joined by +, e.g. prior_prob+posterior_prob."
+        + " Defaults to all subsets of the features",
+    )
+    parser.add_argument("--search_n_jobs", type=int, default=-1)
+    parser.add_argument("--leaderboard_path", type=str, default="clf_leaderboard.csv")
     args = parser.parse_args()
 
-    train_data, test_data = [], []
-    for path in args.train_data_filepath.split(","):
-        train_data += json.load(open(path))
-    for path in args.test_data_filepath.split(","):
-        test_data += json.load(open(path))
-
-    Xy_train = preprocess_data(train_data)
-    Xy_test = preprocess_data(test_data)
+    Xy_train = pd.concat(
+        [load_features(path) for path in args.train_data_filepath.split(",")],
+        ignore_index=True,
+    )
+    Xy_test = pd.concat(
+        [load_features(path) for path in args.test_data_filepath.split(",")],
+        ignore_index=True,
+    )
 
     print("\n -- Ignoring intrinsic hallucations in train and test data -- \n")
 
@@ -122,6 +298,33 @@ if __name__ == "__main__":
     X_test, y_test = build_test_features_and_targets(
         Xy_test, args.ignore_intrinsic, args.test_only_on_hallucinated
     )
+
+    if args.search:
+        if args.search_feature_sets:
+            feature_subsets = [
+                x.split("+") for x in args.search_feature_sets.split(",")
+            ]
+        else:
+            feature_subsets = [
+                list(subset)
+                for n_features in range(1, len(FEATURE_COLUMNS) + 1)
+                for subset in itertools.combinations(FEATURE_COLUMNS, n_features)
+            ]
+        leaderboard = search(
+            X_train,
+            y_train,
+            X_test,
+            y_test,
+            [int(x) for x in args.search_n_neighbors.split(",")],
+            args.search_weights.split(","),
+            feature_subsets,
+            args.search_n_jobs,
+        )
+        leaderboard.to_csv(args.leaderboard_path, index=False)
+        print(leaderboard.head(10).to_string())
+        print(f"saved leaderboard to {args.leaderboard_path}")
+        sys.exit()
+
     model = Pipeline(
         [
             ("scale", StandardScaler()),
@@ -147,3 +350,16 @@ if __name__ == "__main__":
             pickle.dump(model, handle)
 
         print(f"saved model to {args.pickled_clf_path}")
+
+    if args.compiled_clf_path:
+        compile_knn_classifier(model).save(args.compiled_clf_path)
+        print(f"saved compiled model to {args.compiled_clf_path}")
+
+    if args.artifact_dir:
+        compile_knn_classifier(model).save_artifact(
+            args.artifact_dir,
+            label_mapping=LABEL_MAPPING,
+            training_data_hash=hash_files(args.train_data_filepath.split(",")),
+            sklearn_version=sklearn.__version__,
+        )
+        print(f"saved classifier artifact to {args.artifact_dir}")